@@ -1,4 +1,15 @@
 import json
+import math
+import re
+import copy
+import collections
+import contextlib
+import fcntl
+import hashlib
+import inspect
+import itertools
+import shutil
+import tempfile
 import numpy as np
 import csv
 import random
@@ -6,6 +17,7 @@ from ast import literal_eval as make_list
 import discretisedfield as df
 from discretisedfield import util as dfu
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import micromagneticmodel as mm
 import oommfc as mc
 import time
@@ -16,9 +28,16 @@ import matplotlib.pyplot as plt
 import k3d
 import pandas as pd
 import cv2
-from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 import networkx as nx
 
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
 
 def num_rings(num):
     n = 1
@@ -32,69 +51,77 @@ def num_points(rings):
 
 
 def gen_coords(num=37, length=10):
-    n = 0
     Nrows = num_rings(num)
-    coords = np.zeros((3 * Nrows * (Nrows - 1) + 1, 2))
-    height_factor = np.sqrt(3.0) / 2.0;
-
+    height_factor = np.sqrt(3.0) / 2.0
+    rows = []
     for row in range(1, Nrows + 1):
         n_in_row = 2 * Nrows - row
         if row % 2 != 0:
-            for c in np.arange(-(n_in_row - 1) // 2, (n_in_row - 1) // 2 + 1):
-                coords[n][0] = c * length
-                coords[n][1] = (row - 1) * length * height_factor
-                n += 1
-                if row != 1:
-                    coords[n][0] = c * length
-                    coords[n][1] = -(row - 1) * length * height_factor
-                    n += 1
+            c = np.arange(-(n_in_row - 1) // 2, (n_in_row - 1) // 2 + 1)
         else:
-            for c in np.arange(-n_in_row / 2 + .5, n_in_row / 2):
-                coords[n][0] = c * length
-                coords[n][1] = (row - 1) * length * height_factor
-                n += 1
-                coords[n][0] = c * length
-                coords[n][1] = -(row - 1) * length * height_factor
-                n += 1
-    return coords
+            c = np.arange(-n_in_row / 2 + .5, n_in_row / 2)
+        above = np.column_stack((c * length, np.full(len(c), (row - 1) * length * height_factor)))
+        if row == 1:
+            rows.append(above)
+        else:  # each point above the middle row is followed by its mirror image below it
+            below = np.column_stack((c * length, np.full(len(c), -(row - 1) * length * height_factor)))
+            rows.append(np.stack((above, below), axis=1).reshape(-1, 2))
+    return np.concatenate(rows).astype(float)
 
 
 def cubic_packing_coords(layer_spacing=1, layer_radius=0, shape='circle', layer_dims=(0, 0)):
-    coords = []
     if shape == 'rectangle':
         l, w = layer_dims
-        for x in range(-l // 2 + 1, l // 2 + 1):
-            for y in range(-w // 2 + 1, w // 2 + 1):
-                coords.append([x * layer_spacing, y * layer_spacing])
+        x, y = np.meshgrid(np.arange(-l // 2 + 1, l // 2 + 1), np.arange(-w // 2 + 1, w // 2 + 1), indexing='ij')
+        keep = np.ones(x.shape, dtype=bool)
     else:
-        for x in range(-layer_radius, layer_radius + 1):
-            for y in range(-layer_radius, layer_radius + 1):
-                if shape == 'circle':
-                    if x ** 2 + y ** 2 < layer_radius ** 2:
-                        coords.append([x * layer_spacing, y * layer_spacing])
-                if shape == 'hexagon':
-                    if abs(x) <= (2 * layer_radius - abs(y) - 1) // 2:
-                        coords.append([x * layer_spacing, y * layer_spacing])
-    return np.array(coords)
+        x, y = np.meshgrid(np.arange(-layer_radius, layer_radius + 1), np.arange(-layer_radius, layer_radius + 1),
+                           indexing='ij')
+        if shape == 'circle':
+            keep = x ** 2 + y ** 2 < layer_radius ** 2
+        elif shape == 'hexagon':
+            keep = abs(x) <= (2 * layer_radius - abs(y) - 1) // 2
+        else:
+            keep = np.zeros(x.shape, dtype=bool)
+    return np.column_stack((x[keep] * layer_spacing, y[keep] * layer_spacing))
 
 
 def hexa_packing_coords(layer_spacing=1 / (3 ** .5 * 2 / 3), layer_radius=0, shape='circle', layer_dims=(0, 0)):
-    coords = []
+    if shape == 'hexagon':
+        coords = gen_coords(length=1, num=num_points(layer_radius)).reshape(-1, 2)
+        return coords.dot([[0, -1], [1, 0]])  # 90° rotation to make it compatible with circle/rect coords
     if shape == 'rectangle':
         l, w = layer_dims
-        for x in range(0, l):
-            for y in range(0, w):
-                coords.append(((2 * x + (y) % 2) * layer_spacing, (3 ** .5) * (y / 3) * layer_spacing))
+        x, y = np.meshgrid(np.arange(0, l), np.arange(0, w), indexing='ij')
+        keep = np.ones(x.shape, dtype=bool)
     else:
-        for x in range(-2 * layer_radius, 2 * layer_radius + 1):
-            for y in range(-2 * layer_radius, 2 * layer_radius + 1):
-                if shape == 'circle':
-                    if (2 * x + y % 2) ** 2 + ((3 ** .5) * (y / 3)) ** 2 <= layer_radius ** 2:
-                        coords.append([(2 * x + (y) % 2) * layer_spacing, (3 ** .5) * (y / 3) * layer_spacing])
-                if shape == 'hexagon':
-                    coords = gen_coords(length=1, num=num_points(layer_radius)).reshape(-1, 2)
-                    coords = coords.dot([[0, -1], [1, 0]])  # 90° rotation to make it compatible with circle/rect coords
-    return np.array(coords)
+        y_range = np.arange(-2 * layer_radius, 2 * layer_radius + 1)
+        x, y = np.meshgrid(y_range, y_range, indexing='ij')
+        # the y term is squared with python floats, one row at a time, so the points on the edge of the circle
+        # are the same as they have always been
+        y_squared = np.array([((3 ** .5) * (j / 3)) ** 2 for j in y_range.tolist()])
+        if shape == 'circle':
+            keep = (2 * x + y % 2) ** 2 + y_squared[y + 2 * layer_radius] <= layer_radius ** 2
+        else:
+            keep = np.zeros(x.shape, dtype=bool)
+    x, y = x[keep], y[keep]
+    return np.column_stack(((2 * x + y % 2) * layer_spacing, (3 ** .5) * (y / 3) * layer_spacing))
+
+
+def mesh_axis_points(mesh):
+    '''returns the x, y, and z coordinates of the cell centers of a df.Mesh as three 1D arrays. The values are
+       computed the same way as when iterating over the mesh, so they are identical to list(mesh)'''
+    return [np.add(mesh.region.pmin[i], np.multiply(np.add(np.arange(mesh.n[i]), 0.5), mesh.cell[i]))
+            for i in range(3)]
+
+
+label_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'magna', 'labels')
+label_cache_size = 10 * 2 ** 30  # bytes
+
+
+def z_slabs(nz, n):
+    '''returns the boundaries of n nearly equal slabs of nz z planes, as an array of n + 1 plane indices'''
+    return np.linspace(0, nz, n + 1).astype(int)
 
 
 class Lattice:
@@ -128,79 +155,40 @@ class Lattice:
         if layer_dims == (0, 0) and shape == 'rectangle':
             raise AttributeError("lattice of shape 'rectangle should have a nonzero (x, y) for layer_dims'")
         self.layer_dims = layer_dims
+        self.layer_cache = {}
+        self.neighbor_cache = None
+
+    def base_layer(self):
+        '''returns the 2D coordinates of layer 0. They are generated once for each form, shape, and layer size and
+           cached on the lattice; the other layers are offsets of this one.'''
+        key = (self.form, self.shape, self.layer_radius, tuple(self.layer_dims))
+        if key not in self.layer_cache:
+            if self.form == 'hcp' or self.form == 'fcc':
+                coords = hexa_packing_coords(layer_radius=self.layer_radius, layer_dims=self.layer_dims,
+                                             shape=self.shape)
+            else:
+                coords = cubic_packing_coords(layer_radius=self.layer_radius, layer_dims=self.layer_dims,
+                                              shape=self.shape)
+            self.layer_cache[key] = coords
+        return self.layer_cache[key]
+
+    def layer_offset(self, layer):
+        '''returns the (x, y, z) offset of a layer from layer 0'''
+        if self.form == 'hcp':
+            return (3 ** .5 / 3 if layer % 2 == 1 else 0, 0, layer * 6 ** .5 / 3)
+        elif self.form == 'fcc':
+            return ((0, 3 ** .5 / 3, 3 ** .5 / 6)[layer % 3], (0, 0, .5)[layer % 3], layer * 6 ** .5 / 3)
+        elif self.form == 'scp':
+            return (0, 0, layer)
+        elif self.form == 'bcc':
+            return (.5, .5, layer / 2) if layer % 2 == 1 else (0, 0, layer / 2)
 
     def layer_coords(self, layer, z=False):
-        if self.form == 'hcp' or 'fcc':
-            coords = hexa_packing_coords(layer_radius=self.layer_radius, layer_dims=self.layer_dims,
-                                         shape=self.shape)
-            if not z:
-                if self.form == 'hcp':
-                    if layer % 2 == 0:
-                        return coords
-                    elif layer % 2 == 1:
-                        coords[:, 0] = coords[:, 0] + 3 ** .5 / 3
-                        return coords
-                elif self.form == 'fcc':
-                    if layer % 3 == 0:
-                        return coords
-                    elif layer % 3 == 1:
-                        coords[:, 0] = coords[:, 0] + 3 ** .5 / 3
-                        return coords
-                    elif layer % 3 == 2:
-                        coords[:, 0] = coords[:, 0] + 3 ** .5 / 6
-                        coords[:, 1] = coords[:, 1] + .5
-                        return coords
-            elif z:
-                if self.form == 'hcp':
-                    if layer % 2 == 0:
-                        z0 = np.linspace(layer * 6 ** .5 / 3, layer * 6 ** .5 / 3, len(coords[:, 0])).reshape(
-                            len(coords[:, 0]), 1)
-                        return np.append(coords, z0, 1)
-                    elif layer % 2 == 1:
-                        coords[:, 0] = coords[:, 0] + 3 ** .5 / 3
-                        z1 = np.linspace(layer * 6 ** .5 / 3, layer * 6 ** .5 / 3, len(coords[:, 0])).reshape(
-                            len(coords[:, 0]), 1)
-                        return np.append(coords, z1, 1)
-                elif self.form == 'fcc':
-                    if layer % 3 == 0:
-                        z0 = np.linspace(layer * 6 ** .5 / 3, layer * 6 ** .5 / 3, len(coords[:, 0])).reshape(
-                            len(coords[:, 0]), 1)
-                        return np.append(coords, z0, 1)
-                    elif layer % 3 == 1:
-                        coords[:, 0] = coords[:, 0] + 3 ** .5 / 3
-                        z1 = np.linspace(layer * 6 ** .5 / 3, layer * 6 ** .5 / 3, len(coords[:, 0])).reshape(
-                            len(coords[:, 0]), 1)
-                        return np.append(coords, z1, 1)
-                    elif layer % 3 == 2:
-                        coords[:, 0] = coords[:, 0] + 3 ** .5 / 6
-                        coords[:, 1] = coords[:, 1] + .5
-                        z2 = np.linspace(layer * 6 ** .5 / 3, layer * 6 ** .5 / 3, len(coords[:, 0])).reshape(
-                            len(coords[:, 0]), 1)
-                        return np.append(coords, z2, 1)
-        if self.form == 'scp' or 'bcc':
-            coords = cubic_packing_coords(layer_radius=self.layer_radius, layer_dims=self.layer_dims,
-                                          shape=self.shape)
-            if not z:
-                if self.form == 'scp':
-                    return coords
-                elif self.form == 'bcc':
-                    if layer % 2 == 0:
-                        return coords
-                    elif layer % 2 == 1:
-                        coords = coords + .5
-                        return coords
-            if z:
-                if self.form == 'scp':
-                    z0 = np.linspace(layer, layer, len(coords[:, 0])).reshape(len(coords[:, 0]), 1)
-                    return np.append(coords, z0, 1)
-                elif self.form == 'bcc':
-                    if layer % 2 == 0:
-                        z0 = np.linspace(layer / 2, layer / 2, len(coords[:, 0])).reshape(len(coords[:, 0]), 1)
-                        return np.append(coords, z0, 1)
-                    elif layer % 2 == 1:
-                        coords = coords + .5
-                        z1 = np.linspace(layer / 2, layer / 2, len(coords[:, 0])).reshape(len(coords[:, 0]), 1)
-                        return np.append(coords, z1, 1)
+        dx, dy, dz = self.layer_offset(layer)
+        coords = self.base_layer() + (dx, dy)
+        if not z:
+            return coords
+        return np.column_stack((coords, np.full(len(coords), dz, dtype=float)))
 
     def mpl(self):
         '''makes a 2d plot of the lattice using matplotlib'''
@@ -228,13 +216,100 @@ class Lattice:
 
     def list_coords(self):
         '''returns a -1x3 numpy array with the list of all of the coordinates of sphere centers in the lattice'''
-        all_coords = np.empty((0, 0))
-        for layer in range(self.n_layers):
-            all_coords = np.append(all_coords, self.layer_coords(layer, z=True))
-        return all_coords.reshape(-1, 3)
+        base = self.base_layer()
+        offsets = np.array([self.layer_offset(layer) for layer in range(self.n_layers)], dtype=float)
+        coords = np.column_stack((base, np.zeros(len(base))))
+        return (coords[np.newaxis, :, :] + offsets[:, np.newaxis, :]).reshape(-1, 3)
+
+    @property
+    def neighbor_key(self):
+        '''the lattice parameters that determine the neighbor graph'''
+        return [self.form, self.shape, self.n_layers, self.layer_radius, list(self.layer_dims)]
+
+    def neighbor_graph(self, networkx=False):
+        '''returns the nearest neighbor graph of the lattice as CSR arrays (indptr, indices): the neighbors of sphere i
+           are indices[indptr[i]:indptr[i + 1]], in increasing order. Two spheres are neighbors if the square of the
+           distance between their centers is less than 1.0001 (in units of sphere diameters). The graph is built
+           with a KD-tree and cached on the lattice. If networkx is True, it is returned as a networkx Graph.'''
+        if self.neighbor_cache is None or self.neighbor_cache[0] != self.neighbor_key:
+            coords = getattr(self, 'coord_list', None)  # an MNP's coordinates may differ from list_coords()
+            if coords is None:
+                coords = self.list_coords()
+            coords = np.asarray(coords, dtype=float)
+            pairs = cKDTree(coords).query_pairs(1.0001 ** .5 * (1 + 1e-9), output_type='ndarray')
+            r = coords[pairs[:, 0]] - coords[pairs[:, 1]]
+            r_squared = r[:, 0] ** 2 + r[:, 1] ** 2 + r[:, 2] ** 2
+            pairs = pairs[(r_squared > 0) & (r_squared < 1.0001)]
+            rows = np.concatenate((pairs[:, 0], pairs[:, 1]))
+            cols = np.concatenate((pairs[:, 1], pairs[:, 0]))
+            order = np.lexsort((cols, rows))
+            indptr = np.zeros(len(coords) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(rows, minlength=len(coords)), out=indptr[1:])
+            self.neighbor_cache = (self.neighbor_key, indptr, cols[order].astype(np.int64))
+        indptr, indices = self.neighbor_cache[1:]
+        if not networkx:
+            return indptr, indices
+        G = nx.Graph()
+        G.add_nodes_from(range(len(indptr) - 1))
+        for i in range(len(indptr) - 1):
+            G.add_edges_from((i, int(j)) for j in indices[indptr[i]:indptr[i + 1]] if j > i)
+        return G
+
+    def neighbors(self, i):
+        '''returns the indices of the nearest neighbors of sphere i'''
+        indptr, indices = self.neighbor_graph()
+        return indices[indptr[i]:indptr[i + 1]]
+
+    def save_neighbor_graph(self, filename):
+        '''saves the neighbor graph to a .npz file'''
+        indptr, indices = self.neighbor_graph()
+        np.savez(filename, key=json.dumps(self.neighbor_key), indptr=indptr, indices=indices)
+
+    def load_neighbor_graph(self, filename):
+        '''loads a neighbor graph saved by save_neighbor_graph, if the file exists and was saved for a lattice with the
+           same parameters. Returns whether the graph was loaded.'''
+        if not os.path.isfile(filename):
+            return False
+        with np.load(filename) as data:
+            if json.loads(str(data['key'])) != self.neighbor_key:
+                return False
+            self.neighbor_cache = (self.neighbor_key, data['indptr'], data['indices'])
+        return True
+
+
+class GeometryAttribute:
+    '''an MNP attribute that the mesh labels and spatial index depend on. Setting it calls reset_geometry so the
+       cached geometry is rebuilt from the new value the next time it is needed.'''
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        try:
+            return obj.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name) from None
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+        obj.reset_geometry()
 
 
 class MNP(Lattice):
+    coord_list = GeometryAttribute()
+    r_total = GeometryAttribute()
+    r_shell = GeometryAttribute()
+    r_core = GeometryAttribute()
+    x_divs = GeometryAttribute()
+    y_divs = GeometryAttribute()
+    z_divs = GeometryAttribute()
+    form = GeometryAttribute()
+    shape = GeometryAttribute()
+    n_layers = GeometryAttribute()
+    layer_radius = GeometryAttribute()
+    layer_dims = GeometryAttribute()
+
     def __init__(self, id,
                  r_tuple=(4.25e-9, 3.7e-9, 3.2e-9),
                  discretizations=(4, 4, 4),
@@ -251,13 +326,23 @@ class MNP(Lattice):
                  axes_type='random_hexagonal',
                  directory=os.path.join(os.getcwd(), 'MNP_Data'),
                  mesh_csv=None,
-                 loaded_fields=''):
+                 loaded_fields='',
+                 mesh_labels=None):
         super().__init__(name=name, form=form, shape=shape, n_layers=n_layers, layer_radius=layer_radius,
                          layer_dims=layer_dims)
 
+        self.sphere_tree_cache = None
+        self.region_labels = None
+        self.sphere_index = None
+        self.is_in_mnp = None
+        self.nearest_index = None
+        self.nearest_distance = None
+
         self.axes_type = axes_type
         self.coord_list = self.list_coords()
         self.mesh_csv = mesh_csv
+        self.mesh_labels = mesh_labels
+        self.mapped_label_cache = None
 
         self.dirpath = os.path.join(directory, name)
         if not os.path.isdir(self.dirpath):
@@ -282,6 +367,7 @@ class MNP(Lattice):
         self.a_shell, self.a_core = a_tuple
         self.k_shell, self.k_core = k_tuple
 
+        self.load_neighbor_graph(self.neighbor_file)
         if axes is None:
             self.easy_axes = self.make_easy_axes()
         else:
@@ -293,10 +379,6 @@ class MNP(Lattice):
         self.k_field = None
         self.u_field = None
 
-        self.distance_matrix = None
-        self.is_in_mnp = None
-        self.point_list = None
-        self.n = 0
 
         if 'm' in loaded_fields:
             self.m_field = self.load_fields(fields='m')[0]
@@ -311,13 +393,57 @@ class MNP(Lattice):
             self.u_field = self.load_fields(fields='u')[0]
             self.initialized = True
 
+    def reset_geometry(self):
+        '''clears the spatial index, neighbor graph, mesh labels, and distances so they are rebuilt the next time they
+           are needed. This is done automatically when coord_list, the radii, the discretizations, or any of the
+           lattice attributes that change the mesh (form, shape, n_layers, layer_radius, layer_dims) are set; call it
+           by hand only after changing one of them in place, e.g. editing coord_list without reassigning it.'''
+        self.sphere_tree_cache = None
+        self.neighbor_cache = None
+        self.region_labels = None
+        self.sphere_index = None
+        self.is_in_mnp = None
+        self.nearest_index = None
+        self.nearest_distance = None
+        self.mapped_label_cache = None
+
+    @property
+    def neighbor_file(self):
+        '''the file the neighbor graph is saved to by save_mnp'''
+        return os.path.join(self.filepath, 'neighbors_mnp_{}.npz'.format(self.id))
+
     @property
     def scaled_coords(self):
-        scaled = []
-        for n in self.coord_list:
-            i, j, k = n
-            scaled.append((2 * i * self.r_total, 2 * j * self.r_total, 2 * k * self.r_total))
-        return np.array(scaled)
+        return 2 * self.coord_list * self.r_total
+
+    @property
+    def sphere_tree(self):
+        '''a scipy cKDTree of the scaled sphere centers, built the first time it is needed'''
+        if self.sphere_tree_cache is None:
+            self.sphere_tree_cache = cKDTree(self.scaled_coords)
+        return self.sphere_tree_cache
+
+    def nearby_spheres(self, point, r):
+        '''returns the sorted indices of all spheres whose centers might be within r of point. A small margin is
+           added so the exact distance checks done by the callers never miss a sphere.'''
+        return sorted(self.sphere_tree.query_ball_point(point, r * (1 + 1e-9)))
+
+    def nearest_sphere(self, points):
+        '''returns the distance to and the index of the nearest sphere center for a point or an (n, 3) array of
+           points'''
+        return self.sphere_tree.query(points)
+
+    def containing_sphere(self, point, r=None):
+        '''returns the index of the first sphere whose center is closer than r to point (r_total by default), or
+           None if the point is not inside any sphere'''
+        if r is None:
+            r = self.r_total
+        x, y, z = point
+        for index in self.nearby_spheres(point, r):
+            i, j, k = self.coord_list[index].tolist()
+            if ((x - 2 * i * self.r_total) ** 2 + (y - 2 * j * self.r_total) ** 2 + (
+                    z - 2 * k * self.r_total) ** 2) ** .5 < r:
+                return index
 
     def make_easy_axes(self):
         possible_axes = [(0, 1, 0), (3 ** .5 / 2, .5, 0), (3 ** .5 / 2, -.5, 0)]
@@ -330,33 +456,186 @@ class MNP(Lattice):
             axes_list = [(2 * np.random.random() - 1, 2 * np.random.random() - 1, 2 * np.random.random() - 1) for _ in
                          range(len(self.coord_list))]
         elif self.axes_type == 'random_nn':
-            G = nx.Graph()
-            for i in range(len(self.coord_list)):
-                G.add_node(i)
-            for i in range(len(self.coord_list)):
-                for j in range(len(self.coord_list)):
-                    r = self.coord_list[i] - self.coord_list[j]
-                    if 0 < (r[0] ** 2 + r[1] ** 2 + r[2] ** 2) < 1.0001:
-                        G.add_edge(i, j)
-
             axes_list = []
             for i in range(len(self.coord_list)):
-                axes_list.append(tuple(self.coord_list[i] - self.coord_list[list(G.adj[i])[random.randint(0, len(G.adj[i])-1)]]))
+                neighbors = self.neighbors(i)
+                axes_list.append(tuple((self.coord_list[i] - self.coord_list[neighbors[random.randint(0, len(neighbors)-1)]]).tolist()))
 
         else:
             raise AttributeError(
                 "axes_type parameter must be one of 'random_hexagonal', 'random_plane', 'all_random', or 'random_nn'.")
         return axes_list
 
-    def find_distances(self):
-        self.point_list = list(self.mesh)
-        self.distance_matrix = cdist(np.array(self.point_list), self.scaled_coords)
-        self.is_in_mnp = np.any(self.distance_matrix < self.r_shell, axis=1)
+    def find_distances(self, max_memory=2.5e8):
+        '''finds whether each cell of the mesh is inside a shell, the index of the nearest sphere, and the distance
+           to that sphere's center. Cells are in the same order as list(mesh) and are processed in chunks so that
+           the temporary arrays use at most about max_memory bytes. The results are stored as MNP.is_in_mnp (bool),
+           MNP.nearest_index (int32), and MNP.nearest_distance (float32).'''
+        t0 = time.time()
+        mesh = self.mesh
+        axis_points = mesh_axis_points(mesh)
+        n_cells = int(np.prod(mesh.n))
+        chunk_size = max(1, int(max_memory // 128))  # about 128 bytes of temporary arrays per cell
+        self.is_in_mnp = np.empty(n_cells, dtype=bool)
+        self.nearest_index = np.empty(n_cells, dtype=np.int32)
+        self.nearest_distance = np.empty(n_cells, dtype=np.float32)
+        for start in range(0, n_cells, chunk_size):
+            stop = min(start + chunk_size, n_cells)
+            index = np.unravel_index(np.arange(start, stop), mesh.n, order='F')
+            points = np.column_stack([axis_points[i][index[i]] for i in range(3)])
+            distance, nearest = self.nearest_sphere(points)
+            self.is_in_mnp[start:stop] = distance < self.r_shell
+            self.nearest_index[start:stop] = nearest
+            self.nearest_distance[start:stop] = distance
+        print('Distances found in {} s'.format(time.time() - t0))
+
+    def label_planes(self, start, stop, max_memory=2.5e8):
+        '''labels the cells in the z planes start to stop of the mesh as outside (0), shell (1), or core (2) and finds
+           the index of the sphere each cell belongs to (-1 for none). Each cell only looks up the spheres near it in
+           sphere_tree, and the cells are processed in chunks so that the temporary arrays use at most about
+           max_memory bytes. Returns two arrays of shape (nx, ny, stop - start): the uint8 region labels and the int32
+           sphere indices.'''
+        xs, ys, zs = mesh_axis_points(self.mesh)
+        shape = (len(xs), len(ys), stop - start)
+        labels = np.zeros(shape, dtype=np.uint8, order='F')
+        spheres = np.full(shape, -1, dtype=np.int32, order='F')
+        flat_labels, flat_spheres = labels.reshape(-1, order='F'), spheres.reshape(-1, order='F')
+        radii = (self.r_shell, self.r_core, self.r_total)
+        reach = max(radii) * (1 + 1e-9)
+        # the spheres within reach of a cell are all within 2 * reach of each other, so the k nearest always include
+        # every one of them
+        k = int(self.sphere_tree.query_ball_point(self.scaled_coords, 2 * reach, return_length=True).max())
+        n_cells = int(np.prod(shape))
+        chunk_size = max(1, int(max_memory // (40 * k + 64)))  # bytes of temporary arrays per cell
+        for chunk in range(0, n_cells, chunk_size):
+            cells = np.arange(chunk, min(chunk + chunk_size, n_cells))
+            i, j, k_plane = np.unravel_index(cells, shape, order='F')
+            points = np.column_stack((xs[i], ys[j], zs[start + k_plane]))
+            dist, nearest = self.sphere_tree.query(points, k=k, distance_upper_bound=reach)
+            dist, nearest = dist.reshape(len(cells), k), nearest.reshape(len(cells), k)
+            d_min = dist[:, 0]
+            flat_labels[cells] = np.where(d_min < self.r_shell, np.where(d_min < self.r_core, 2, 1), 0)
+            first = np.where(dist < self.r_total, nearest, len(self.coord_list)).min(axis=1)
+            flat_spheres[cells] = np.where(first < len(self.coord_list), first, -1)
+
+            # cells within rounding distance of a sphere boundary are rechecked with the scalar functions so the
+            # labels always match what the per-point functions would give
+            borderline = np.zeros(len(cells), dtype=bool)
+            for r in radii:
+                borderline |= np.any(np.abs(dist - r) <= 1e-12 * r, axis=1)
+            for cell, point in zip(cells[borderline], points[borderline].tolist()):
+                if self.if_circle(point, self.r_shell):
+                    flat_labels[cell] = 2 if self.if_circle(point, self.r_core) else 1
+                else:
+                    flat_labels[cell] = 0
+                index = self.containing_sphere(point)
+                flat_spheres[cell] = -1 if index is None else index
+        return labels, spheres
+
+    def label_mesh(self, workers=1):
+        '''labels every cell of the mesh using label_planes and stores the results in MNP.region_labels and
+           MNP.sphere_index, both arrays with the shape of the mesh. If workers is more than 1, slabs of z planes
+           are labeled in parallel on a pool of that many processes (None uses every available core).'''
+        t0 = time.time()
+        nz = self.mesh.n[2]
+        if workers == 1:
+            self.region_labels, self.sphere_index = self.label_planes(0, nz)
+        else:
+            bounds = z_slabs(nz, 4 * (workers or os.cpu_count()))
+            geometry = self.geometry_copy()
+            with ProcessPoolExecutor(workers) as pool:
+                results = list(pool.map(geometry.label_planes, bounds[:-1], bounds[1:]))
+            self.region_labels = np.concatenate([labels for labels, _ in results], axis=2)
+            self.sphere_index = np.concatenate([spheres for _, spheres in results], axis=2)
+        print('Mesh labeled in {} s'.format(time.time() - t0))
+        return self.region_labels, self.sphere_index
+
+    def geometry_copy(self):
+        '''returns a shallow copy of the MNP without its fields or cached arrays, which is cheap to send to worker
+           processes'''
+        geometry = copy.copy(self)
+        geometry.__dict__.update(m_field=None, a_field=None, k_field=None, u_field=None, mapped_label_cache=None)
+        geometry.reset_geometry()
+        geometry.neighbor_cache = self.neighbor_cache
+        return geometry
+
+    @property
+    def label_header(self):
+        '''a dictionary describing the mesh and lattice geometry, saved with pregenerated mesh labels so that they
+           can be checked against the MNP they are loaded into'''
+        mesh = self.mesh
+        return {'p1': [float(p) for p in mesh.region.pmin],
+                'p2': [float(p) for p in mesh.region.pmax],
+                'cell': [float(c) for c in mesh.cell],
+                'n': [int(n) for n in mesh.n],
+                'r_tuple': [self.r_total, self.r_shell, self.r_core],
+                'form': self.form,
+                'shape': self.shape,
+                'n_layers': self.n_layers,
+                'layer_radius': self.layer_radius,
+                'layer_dims': list(self.layer_dims),
+                'coords': hashlib.sha256(np.ascontiguousarray(self.coord_list, dtype=float).tobytes()).hexdigest(),
+                'planes': [0, int(mesh.n[2])]}
+
+    def pregenerate_labels(self, filename=None, workers=None, shard=None):
+        '''labels the mesh on a pool of worker processes (every available core by default) and saves the labels to
+           filename, by default {filepath}/mesh_labels_mnp_{id}.mesh. If shard=(k, n) is given, only the k-th of n
+           slabs of z planes is labeled, using a single process, and saved to {filename}.{k}. This lets separate
+           jobs (for example a SLURM array) each label one shard, and merge_mesh_labels(filename, n) then combines
+           them into the full file.'''
+        if filename is None:
+            filename = os.path.join(self.filepath, 'mesh_labels_mnp_{}.mesh'.format(self.id))
+        header = self.label_header
+        if shard is None:
+            self.label_mesh(workers=workers)
+            labels, spheres = self.region_labels, self.sphere_index
+        else:
+            k, n = shard
+            bounds = z_slabs(header['n'][2], n)
+            header['planes'] = [int(bounds[k]), int(bounds[k + 1])]
+            labels, spheres = self.label_planes(*header['planes'])
+            filename = '{}.{}'.format(filename, k)
+        save_mesh_labels(filename, header, labels, spheres)
+        print('Mesh labels saved: ', filename)
+        return filename
+
+    def cached_labels(self):
+        '''loads the mesh labels from the label cache if an MNP with the same geometry has been labeled before.
+           Otherwise the mesh is labeled and the labels are added to the cache, evicting the least recently used
+           entries if the cache grows beyond label_cache_size.'''
+        header = self.label_header
+        filename = label_cache_path(header)
+        if os.path.isfile(filename):
+            cached_header, labels, spheres = load_mesh_labels(filename)
+            if cached_header == header:
+                os.utime(filename)  # marks the entry as recently used
+                self.region_labels, self.sphere_index = labels, spheres
+                print('Mesh labels loaded from cache: ', filename)
+                return
+        self.label_mesh()
+        temp = '{}.{}.tmp'.format(filename, os.getpid())
+        try:
+            os.makedirs(label_cache_dir, exist_ok=True)
+            save_mesh_labels(temp, header, self.region_labels, self.sphere_index)
+            os.replace(temp, filename)
+        except OSError as e:
+            print('Mesh labels not added to the cache: ', repr(e))
+            return
+        prune_label_cache()
+
+    def load_labels(self, filename=None):
+        '''loads mesh labels saved by pregenerate_labels into MNP.region_labels and MNP.sphere_index, so that the
+           fields are made from them instead of labeling the mesh again. If filename is None, the MNP's own
+           mesh_labels (or mesh_csv) file is used.'''
+        if filename is not None:
+            self.mesh_labels = filename
+            self.mapped_label_cache = None
+        _, self.region_labels, self.sphere_index = self.mapped_labels()
 
     def if_circle(self, point, r):
         '''Deprecated'''
         x, y, z = point
-        for n in self.coord_list:
+        for n in self.coord_list[self.nearby_spheres(point, r)]:
             i, j, k = n
             if ((x - 2 * i * self.r_total) ** 2 + (y - 2 * j * self.r_total) ** 2 + (
                     z - 2 * k * self.r_total) ** 2) ** .5 < r:
@@ -366,7 +645,7 @@ class MNP(Lattice):
 
     def if_coreshell(self, point):
         x, y, z = point
-        for n in self.coord_list:
+        for n in self.coord_list[self.nearby_spheres(point, max(self.r_core, self.r_shell))]:
             i, j, k = n
             dist = ((x - 2 * i * self.r_total) ** 2 + (y - 2 * j * self.r_total) ** 2 + (z - 2 * k * self.r_total) ** 2)** .5
             if dist <= self.r_core:
@@ -376,6 +655,56 @@ class MNP(Lattice):
         else:
             return 0
 
+    def mapped_labels(self):
+        '''returns the header, region labels, and sphere indices from the mesh label file, with the arrays in the
+           shape of the mesh. The file is memory-mapped the first time this is called and shared by all of the
+           alt_* field makers. A mesh_csv from the old mesh_making scripts is converted to a mesh label file first.
+           A ValueError is raised if the header does not match the geometry of the MNP.'''
+        if self.mapped_label_cache is None:
+            if self.mesh_labels is None:
+                self.mesh_labels = self.convert_mesh_csv(self.mesh_csv)
+            header, labels, spheres = load_mesh_labels(self.mesh_labels)
+            expected = self.label_header
+            if header != expected:
+                mismatched = [key for key in expected if header.get(key) != expected[key]]
+                raise ValueError('Mesh labels in {} do not match MNP {} (different {})'.format(
+                    self.mesh_labels, self.id, ', '.join(mismatched)))
+            self.mapped_label_cache = (header, labels, spheres)
+        return self.mapped_label_cache
+
+    def cell_index(self, point):
+        '''returns the (i, j, k) index of the mesh cell that contains point, computed from the mesh geometry in the
+           mesh label header'''
+        header = self.mapped_labels()[0]
+        index = np.round(np.divide(np.subtract(point, header['p1']), header['cell']) - 0.5).astype(int)
+        return tuple(np.clip(index, 0, np.subtract(header['n'], 1)))
+
+    def convert_mesh_csv(self, mesh_csv, filename=None):
+        '''converts a text mesh csv (x, y, z, label per cell) into a mesh label file, saved as {mesh_csv}.mesh by
+           default, and returns its filename. The csv is only parsed if the label file is missing or older than
+           it. The csv has no sphere indices, so they are found with the spatial index like circle_index would.'''
+        if filename is None:
+            filename = mesh_csv + '.mesh'
+        if os.path.isfile(filename) and os.path.getmtime(filename) >= os.path.getmtime(mesh_csv):
+            return filename
+        labels = pd.read_csv(mesh_csv, header=None, usecols=[3]).to_numpy().ravel().astype(np.uint8)
+        if len(labels) != np.prod(self.mesh.n):
+            raise ValueError('{} has {} rows but the mesh of MNP {} has {} cells'.format(
+                mesh_csv, len(labels), self.id, np.prod(self.mesh.n)))
+        xs, ys, zs = mesh_axis_points(self.mesh)
+        cells = np.flatnonzero(labels)
+        index = np.unravel_index(cells, self.mesh.n, order='F')
+        points = np.column_stack((xs[index[0]], ys[index[1]], zs[index[2]]))
+        distance, nearby = self.sphere_tree.query(points, k=min(8, len(self.coord_list)),
+                                                  distance_upper_bound=self.r_total)
+        nearby = np.where(distance < self.r_total, nearby, len(self.coord_list)).reshape(len(points), -1).min(axis=1)
+        spheres = np.full(len(labels), -1, dtype=np.int32)
+        spheres[cells] = np.where(nearby < len(self.coord_list), nearby, -1)
+        save_mesh_labels(filename, self.label_header, labels.reshape(self.mesh.n, order='F'),
+                         spheres.reshape(self.mesh.n, order='F'))
+        print('Mesh csv converted: ', filename)
+        return filename
+
     def ms_func(self, point):
         if self.if_circle(point, self.r_shell) and self.if_circle(point, self.r_core):
             return self.ms_core  # Fe3O4 Exchange stiffness constant (J/m)
@@ -385,14 +714,12 @@ class MNP(Lattice):
             return 0
 
     def alt_ms_func(self, point):
-        if int(self.arrayz[self.n][3]) == 2:
-            self.n +=1
+        label = self.mapped_labels()[1][self.cell_index(point)]
+        if label == 2:
             return self.ms_core
-        elif int(self.arrayz[self.n][3]) == 1:
-            self.n+=1
+        elif label == 1:
             return self.ms_shell
-        else: 
-            self.n+=1
+        else:
             return 0
 
     def a_func(self, point):
@@ -404,14 +731,12 @@ class MNP(Lattice):
             return 0
 
     def alt_a_func(self, point):
-        if int(self.arrayz[self.n][3]) == 2:
-            self.n +=1
+        label = self.mapped_labels()[1][self.cell_index(point)]
+        if label == 2:
             return self.a_core
-        elif int(self.arrayz[self.n][3]) == 1:
-            self.n+=1
+        elif label == 1:
             return self.a_shell
-        else: 
-            self.n+=1
+        else:
             return 0
 
 
@@ -424,38 +749,37 @@ class MNP(Lattice):
             return 0
 
     def alt_k_func(self, point):
-        if int(self.arrayz[self.n][3]) == 2:
-            self.n +=1
+        label = self.mapped_labels()[1][self.cell_index(point)]
+        if label == 2:
             return self.k_core
-        elif int(self.arrayz[self.n][3]) == 1:
-            self.n+=1
+        elif label == 1:
             return self.k_shell
-        else: 
-            self.n+=1
+        else:
             return 0
 
-    def circle_index(self, point, n_list):
+    def circle_index(self, point, n_list=None):
+        if n_list is None or n_list is self.coord_list:
+            return self.containing_sphere(point)
         x, y, z = point
-        n_list = n_list.tolist()
-        for n in n_list:
+        for index, n in enumerate(n_list.tolist()):
             i, j, k = n
             if ((x - 2 * i * self.r_total) ** 2 + (y - 2 * j * self.r_total) ** 2 + (
                     z - 2 * k * self.r_total) ** 2) ** .5 < self.r_total:
-                return n_list.index(n)
+                return index
 
     def u_func(self, point):
         if not self.if_circle(point, self.r_shell):
             return (0, 0, 1)
         else:
-            return self.easy_axes[self.circle_index(point, self.coord_list)]
+            return self.easy_axes[self.containing_sphere(point)]
 
     def alt_u_func(self, point):
-        if int(self.arrayz[self.n][3]) == 0:
-            self.n += 1
+        header, labels, spheres = self.mapped_labels()
+        index = self.cell_index(point)
+        if labels[index] == 0:
             return (0, 0, 1)
         else:
-            self.n += 1
-            return self.easy_axes[self.circle_index(point, self.coord_list)]
+            return self.easy_axes[spheres[index]]
 
     @property
     def mesh(self):
@@ -472,70 +796,67 @@ class MNP(Lattice):
                     2 * self.n_layers * self.r_total),
                 cell=(self.r_total / self.x_divs, self.r_total / self.y_divs, self.r_total / self.z_divs))
 
+    def region_values(self, shell_value, core_value):
+        '''returns an array with the shape of the mesh (plus a trailing axis of length 1) that is 0 outside of the
+           MNPs, shell_value in the shells, and core_value in the cores'''
+        if self.region_labels is None:
+            self.label_mesh()
+        return np.array([0, shell_value, core_value])[self.region_labels][..., np.newaxis]
+
     def make_m_field(self, m0='random'):
         t0 = time.time()
         if m0 == 'random':
             self.m_field = df.Field(self.mesh, dim=3,
-                                    value=lambda point: [2 * random.random() - 1 for _ in range(3)],
-                                    norm=self.ms_func)
+                                    value=2 * np.random.random(self.mesh.n + (3,)) - 1,
+                                    norm=self.region_values(self.ms_shell, self.ms_core))
         elif type(m0) == type((0, 0, 0)):
             self.m_field = df.Field(self.mesh, dim=3,
                                     value=m0,
-                                    norm=self.ms_func)
+                                    norm=self.region_values(self.ms_shell, self.ms_core))
         print('M Field made in {} s'.format(time.time()-t0))
 
     def alt_make_m_field(self, m0='random'):
-        self.n = 0
-        self.arrayz = np.genfromtxt(self.mesh_csv, delimiter=',')
-        t0 = time.time()
-        if m0 == 'random':
-            self.m_field = df.Field(self.mesh, dim=3,
-                                    value=lambda point: [2 * random.random() - 1 for _ in range(3)],
-                                    norm=self.alt_ms_func)
-        elif type(m0) == type((0, 0, 0)):
-            self.m_field = df.Field(self.mesh, dim=3,
-                                    value=m0,
-                                    norm=self.alt_ms_func)
-        print('M Field made in {} s'.format(time.time()-t0))
+        self.load_labels()
+        self.make_m_field(m0=m0)
 
     def make_a_field(self):
         t0 = time.time()
-        self.a_field = df.Field(self.mesh, dim=1, value=self.a_func)
+        self.a_field = df.Field(self.mesh, dim=1, value=self.region_values(self.a_shell, self.a_core))
         print('A Field made in {} s'.format(time.time()-t0))
 
     def alt_make_a_field(self):
-        t0 = time.time()
-        self.n = 0
-        self.arrayz = np.genfromtxt(self.mesh_csv, delimiter=',')
-        self.a_field = df.Field(self.mesh, dim=1, value=self.alt_a_func)
-        print('A Field made in {} s'.format(time.time()-t0))
+        self.load_labels()
+        self.make_a_field()
 
     def make_k_field(self):
         t0 = time.time()
-        self.k_field = df.Field(self.mesh, dim=1, value=self.k_func)
+        self.k_field = df.Field(self.mesh, dim=1, value=self.region_values(self.k_shell, self.k_core))
         print('K Field made in {} s'.format(time.time()-t0))
 
     def alt_make_k_field(self):
-        t0 = time.time()
-        self.n = 0
-        self.arrayz = np.genfromtxt(self.mesh_csv, delimiter=',')
-        self.k_field = df.Field(self.mesh, dim=1, value=self.alt_k_func)
-        print('K Field made in {} s'.format(time.time()-t0))
+        self.load_labels()
+        self.make_k_field()
 
     def make_u_field(self):
         t0 = time.time()
-        self.u_field = df.Field(self.mesh, dim=3, value=self.u_func)
+        if self.region_labels is None:
+            self.label_mesh()
+        axes = np.array([(0, 0, 1)] + list(self.easy_axes), dtype=float)  # row 0 is used outside of the MNPs
+        self.u_field = df.Field(self.mesh, dim=3,
+                                value=axes[np.where(self.region_labels == 0, 0, self.sphere_index + 1)])
         print('U Field made in {} s'.format(time.time()-t0))
 
     def alt_make_u_field(self):
-        t0 = time.time()
-        self.n = 0
-        self.arrayz = np.genfromtxt(self.mesh_csv, delimiter=',')        
-        self.u_field = df.Field(self.mesh, dim=3, value=self.alt_u_func)
-        print('U Field made in {} s'.format(time.time()-t0))
-
-    def initialize(self, fields='maku', autosave=True, m0='random'):
-        if self.mesh_csv is None:
+        self.load_labels()
+        self.make_u_field()
+
+    def initialize(self, fields='maku', autosave=True, m0='random', label_cache=True):
+        '''makes the m, a, k, and u fields listed in fields. Unless label_cache is False, the mesh labels are loaded
+           from (or added to) the on-disk label cache in label_cache_dir (~/.cache/magna/labels by default), which is
+           kept below label_cache_size bytes (10 GiB by default) by deleting the least recently used entries.'''
+        if self.mesh_csv is None and self.mesh_labels is None:
+            if label_cache and self.region_labels is None:
+                self.cached_labels()
             if 'm' in fields:
                 self.make_m_field(m0=m0)
             if 'a' in fields:
@@ -552,7 +873,7 @@ class MNP(Lattice):
             if 'k' in fields:
                 self.alt_make_k_field()
             if 'u' in fields:
-                self.alt_make_u_field()            
+                self.alt_make_u_field()
         self.initialized = True
         if autosave:
             save_mnp(self)
@@ -579,12 +900,20 @@ class MNP(Lattice):
         if 'u' in fields:
             self.u_field.write(os.path.join(path, 'u_field_mnp_{}.ovf'.format(self.id)))
 
-    def save_any_field(self, field, field_name, filepath='default'):
+    def save_any_field(self, field, field_name, filepath='default', atomic=False):
+        '''saves a field as {field_name}_mnp_{id}.ovf. If atomic is True, it is written to a temporary file first and
+           then renamed, so the file is never left half written.'''
         if filepath == 'default':
             path = self.filepath
         else:
             path = filepath
-        field.write(os.path.join(path, '{}_mnp_{}.ovf'.format(field_name, self.id)))
+        filename = os.path.join(path, '{}_mnp_{}.ovf'.format(field_name, self.id))
+        if not atomic:
+            field.write(filename)
+            return
+        tmp = os.path.join(path, 'partial_{}.ovf'.format(os.getpid()))
+        field.write(tmp)
+        os.replace(tmp, filename)
 
     def load_fields(self, fields='maku', filepath='default'):
         if filepath == 'default':
@@ -661,6 +990,7 @@ def save_mnp(mnp, summary=True, filepath='default'):
         write = csv.writer(f)
         write.writerow(data_list)
     print('MNP Data Saved: ', os.path.join(path, 'data_mnp_{}.mnp'.format(mnp.id)))
+    mnp.save_neighbor_graph(os.path.join(path, 'neighbors_mnp_{}.npz'.format(mnp.id)))
     if summary:
         with open(os.path.join(path, 'summary_mnp_{}.md'.format(mnp.id)), 'w') as f:
             f.write(mnp.summary)
@@ -683,9 +1013,136 @@ def load_mnp(id, name='lattice', filepath='./MNP_Data', fields=''):
                    loaded_fields=fields)
 
 
+def save_mesh_labels(filename, header, labels, spheres):
+    '''saves mesh labels as three consecutive .npy blocks in one file: the JSON header as bytes, the uint8 region
+       labels, and the int32 sphere indices. The arrays are stored in Fortran order (x fastest, like iterating
+       over the mesh), so each slab of z planes is one contiguous piece of the file.'''
+    with open(filename, 'wb') as f:
+        np.lib.format.write_array(f, np.frombuffer(json.dumps(header).encode(), dtype=np.uint8))
+        np.lib.format.write_array(f, np.asfortranarray(labels, dtype=np.uint8))
+        np.lib.format.write_array(f, np.asfortranarray(spheres, dtype=np.int32))
+
+
+def mesh_label_blocks(filename):
+    '''returns (offset, shape, fortran_order, dtype) for each of the .npy blocks in a mesh label file'''
+    blocks = []
+    with open(filename, 'rb') as f:
+        for _ in range(3):
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            blocks.append((f.tell(), shape, fortran_order, dtype))
+            f.seek(int(np.prod(shape)) * dtype.itemsize, 1)
+    return blocks
+
+
+def load_mesh_labels(filename, mmap=True):
+    '''returns the header, region labels, and sphere indices saved by save_mesh_labels. Unless mmap is False, the
+       arrays are memory-mapped read-only rather than read into memory.'''
+    header_block, label_block, sphere_block = mesh_label_blocks(filename)
+    arrays = []
+    for offset, shape, fortran_order, dtype in (label_block, sphere_block):
+        if np.prod(shape) == 0:
+            arrays.append(np.empty(shape, dtype=dtype))
+            continue
+        array = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape,
+                          order='F' if fortran_order else 'C')
+        arrays.append(array if mmap else np.array(array))
+    return mesh_label_header(filename), arrays[0], arrays[1]
+
+
+def mesh_label_header(filename):
+    '''returns the header dictionary of a mesh label file without loading the labels'''
+    offset, shape, _, _ = mesh_label_blocks(filename)[0]
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        return json.loads(f.read(shape[0]).decode())
+
+
+def merge_mesh_labels(filename, n, remove=True):
+    '''combines the shards {filename}.0 to {filename}.{n - 1} written by MNP.pregenerate_labels(shard=(k, n)) into
+       one mesh label file. Each shard is copied straight into place, so this takes time linear in the file size.
+       The shards are deleted afterwards unless remove is False.'''
+    shards = ['{}.{}'.format(filename, k) for k in range(n)]
+    headers = [mesh_label_header(shard) for shard in shards]
+    header = dict(headers[0], planes=[0, headers[0]['n'][2]])
+    for k, shard_header in enumerate(headers):
+        if dict(shard_header, planes=header['planes']) != header:
+            raise ValueError('Shard {} was generated for a different mesh'.format(shards[k]))
+        if shard_header['planes'][0] != (headers[k - 1]['planes'][1] if k > 0 else 0):
+            raise ValueError('Shard {} does not continue from the previous shard'.format(shards[k]))
+    if headers[-1]['planes'][1] != header['planes'][1]:
+        raise ValueError('The shards do not cover every z plane of the mesh')
+
+    with open(filename, 'wb') as f:
+        np.lib.format.write_array(f, np.frombuffer(json.dumps(header).encode(), dtype=np.uint8))
+        for block, dtype in ((1, np.uint8), (2, np.int32)):
+            np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                     'fortran_order': True, 'shape': tuple(header['n'])})
+            for shard in shards:
+                offset, shape, _, shard_dtype = mesh_label_blocks(shard)[block]
+                with open(shard, 'rb') as r:
+                    r.seek(offset)
+                    f.write(r.read(int(np.prod(shape)) * shard_dtype.itemsize))
+    if remove:
+        for shard in shards:
+            os.remove(shard)
+    print('Mesh labels merged: ', filename)
+
+
+def label_cache_path(header):
+    '''returns the file in the label cache for mesh labels with the given header, named by a hash of the header'''
+    key = hashlib.sha256(json.dumps(header, sort_keys=True).encode()).hexdigest()
+    return os.path.join(label_cache_dir, key + '.mesh')
+
+
+def prune_label_cache(max_size=None):
+    '''deletes the least recently used mesh label files from the label cache until the cache is no bigger than
+       max_size bytes (label_cache_size by default)'''
+    if max_size is None:
+        max_size = label_cache_size
+    if not os.path.isdir(label_cache_dir):
+        return
+    entries = []
+    for f in os.listdir(label_cache_dir):
+        if f.endswith('.mesh'):
+            stat = os.stat(os.path.join(label_cache_dir, f))
+            entries.append((stat.st_mtime, stat.st_size, f))
+    total = sum(size for _, size, _ in entries)
+    for _, size, f in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(os.path.join(label_cache_dir, f))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+scratch_root = None  # where OOMMF runs; None uses each MNP's folder, or e.g. '/dev/shm' for a local RAM disk
+
+
+@contextlib.contextmanager
+def scratch_dir(mnp, root=None):
+    '''creates a new, uniquely named directory for the OOMMF files of one drive, under root (scratch_root, or the MNP's
+       folder if that is None). The directory is deleted if the drive succeeds and kept if it fails.'''
+    if root is None:
+        root = scratch_root if scratch_root is not None else mnp.filepath
+    os.makedirs(root, exist_ok=True)
+    dirname = tempfile.mkdtemp(prefix='oommf_{}_mnp_{}_'.format(mnp.name, mnp.id), dir=root)
+    try:
+        yield dirname
+    except BaseException:
+        print('Drive failed; OOMMF files kept in ', dirname)
+        raise
+    shutil.rmtree(dirname, ignore_errors=True)
+
+
 class MNP_System(mm.System):
-    def __init__(self, mnp, **kwargs):
-        super().__init__(name='DELETE', **kwargs)
+    def __init__(self, mnp, name=None, **kwargs):
+        super().__init__(name='mnp_{}'.format(mnp.id) if name is None else name, **kwargs)
         self.mnp = mnp
 
     def initialize(self, m0='random', Demag=True, Exchange=True, UniaxialAnisotropy=True, Zeeman=True,
@@ -704,41 +1161,268 @@ class MNP_System(mm.System):
             self.energy += mm.Zeeman(H=H)
 
 
+def manifest_path(mnp):
+    '''the run manifest of an MNP, a small json index of the steps saved in its drives directory'''
+    return os.path.join(mnp.filepath, 'drives', 'manifest.json')
+
+
+@contextlib.contextmanager
+def file_lock(filename, shared=False):
+    '''holds an exclusive lock on a hidden lock file next to filename (.{name}.lock) so that only one process changes
+       it at a time. With shared=True, the lock is shared with other readers but not with a writer. The lock is
+       released by the operating system if the holding process dies, so it never has to be broken, and the lock file
+       itself is left in place.'''
+    dirname, basename = os.path.split(filename)
+    lockfile = os.path.join(dirname, '.{}.lock'.format(basename))
+    os.makedirs(dirname or '.', exist_ok=True)
+    fd = os.open(lockfile, os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def manifest_lock(mnp):
+    '''holds the lock of the run manifest of an MNP'''
+    return file_lock(manifest_path(mnp))
+
+
+def read_manifest(mnp):
+    '''returns the run manifest of an MNP as a dictionary with 'next_step', the next unused step number, and 'steps',
+       a dictionary of information about each saved step. If there is no manifest yet (for data from an older
+       version), one is made by listing the drives directory once.'''
+    if os.path.isfile(manifest_path(mnp)):
+        with open(manifest_path(mnp)) as f:
+            return json.load(f)
+    drivepath = os.path.join(mnp.filepath, 'drives')
+    steps = []
+    if os.path.isdir(drivepath):
+        pattern = re.compile(r'm_final_(\d+)_mnp_{}\.ovf$'.format(mnp.id))
+        steps = sorted(int(m.group(1)) for m in map(pattern.match, os.listdir(drivepath)) if m)
+    return {'next_step': steps[-1] + 1 if steps else 0,
+            'steps': {str(step): {'file': 'm_final_{}_mnp_{}.ovf'.format(step, mnp.id)} for step in steps}}
+
+
+def write_manifest(mnp, manifest):
+    '''atomically replaces the run manifest of an MNP'''
+    tmp = '{}.{}.tmp'.format(manifest_path(mnp), os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, manifest_path(mnp))
+
+
+def allocate_steps(mnp, n=1):
+    '''reserves n consecutive step numbers for new m_final fields of an MNP and returns the first one. This only reads
+       and writes the manifest, and is safe to use from several processes at once.'''
+    with manifest_lock(mnp):
+        manifest = read_manifest(mnp)
+        step = manifest['next_step']
+        manifest['next_step'] = step + n
+        write_manifest(mnp, manifest)
+    return step
+
+
+def record_step(mnp, step, **info):
+    '''adds a saved m_final step to the run manifest of an MNP, with the time and any other information given (such
+       as the applied field)'''
+    with manifest_lock(mnp):
+        manifest = read_manifest(mnp)
+        manifest['steps'][str(step)] = dict({'file': 'm_final_{}_mnp_{}.ovf'.format(step, mnp.id),
+                                             'time': time.time(), 'date': time.asctime()}, **info)
+        manifest['next_step'] = max(manifest['next_step'], step + 1)
+        write_manifest(mnp, manifest)
+
+
 def how_many_m_finals(mnp):
-    path, dirs, files = next(os.walk(os.path.join(mnp.filepath, 'drives')))
-    number = 0
-    for f in files:
-        if 'm_final' in f:
-            number += 1
-    return number
+    '''returns the number of m_final steps that have been allocated for an MNP, from its run manifest'''
+    return read_manifest(mnp)['next_step']
+
+
+def m_final_steps(mnp):
+    '''returns the sorted list of steps that have an m_final field saved in the drives directory of an MNP'''
+    return sorted(int(step) for step in read_manifest(mnp)['steps'])
+
+
+def field_info(h):
+    '''returns the applied field h (in A/m) in T as a dictionary for the run manifest'''
+    return {'Bx': float(h[0] * mm.consts.mu0), 'By': float(h[1] * mm.consts.mu0), 'Bz': float(h[2] * mm.consts.mu0)}
+
+
+step_store = 'ovf'
+
+
+def store_path(mnp):
+    '''the run store of an MNP, one HDF5 file that holds the m_final fields of all of its steps'''
+    return os.path.join(mnp.filepath, 'drives', 'steps_mnp_{}.h5'.format(mnp.id))
+
+
+def store_mesh(f):
+    '''returns the mesh saved in an open run store'''
+    return df.Mesh(p1=tuple(f.attrs['pmin']), p2=tuple(f.attrs['pmax']), n=tuple(int(i) for i in f.attrs['n']))
+
+
+@contextlib.contextmanager
+def open_store(mnp, mode='r'):
+    '''opens the run store of an MNP with h5py while holding its lock, shared for reading (mode 'r') and exclusive
+       for writing'''
+    if h5py is None:
+        raise ModuleNotFoundError('h5py is needed to use the run store {}'.format(store_path(mnp)))
+    with file_lock(store_path(mnp), shared=mode == 'r'):
+        with h5py.File(store_path(mnp), mode) as f:
+            yield f
+
+
+def save_step_field(mnp, field, step, store=None):
+    '''saves the m_final field of a step of an MNP and returns its run manifest information. With store='ovf' the field
+       is saved as drives/m_final_{step}_mnp_{id}.ovf. With store='h5' it is saved as a compressed dataset in the run
+       store (see store_path), which keeps the mesh once for all steps and is chunked by z plane so single planes can
+       be read on their own. The default is the module setting step_store.'''
+    store = step_store if store is None else store
+    if store == 'ovf':
+        mnp.save_any_field(field, field_name='m_final_{}'.format(step), filepath=os.path.join(mnp.filepath, 'drives'),
+                           atomic=True)
+        return {'file': 'm_final_{}_mnp_{}.ovf'.format(step, mnp.id), 'store': 'ovf'}
+    if store != 'h5':
+        raise AttributeError("store must be 'ovf' or 'h5', not {}".format(store))
+    mesh = field.mesh
+    with open_store(mnp, 'a') as f:
+        if 'n' not in f.attrs:
+            f.attrs['pmin'], f.attrs['pmax'], f.attrs['n'] = mesh.region.pmin, mesh.region.pmax, mesh.n
+        elif tuple(f.attrs['n']) != tuple(mesh.n) or not np.allclose(f.attrs['pmin'], mesh.region.pmin):
+            raise ValueError('The mesh of step {} does not match the run store {}'.format(step, store_path(mnp)))
+        name = 'm_final_{}'.format(step)
+        if name in f:
+            del f[name]
+        f.create_dataset(name, data=field.array, chunks=(mesh.n[0], mesh.n[1], 1, field.dim),
+                         compression='gzip', shuffle=True)
+    return {'file': os.path.basename(store_path(mnp)), 'dataset': name, 'store': 'h5'}
+
+
+def step_file(mnp, step):
+    '''returns the run manifest entry of a step of an MNP (None if it has none) and the .ovf file its m_final field is
+       read from, or None for a step saved in the run store. For step 0, an m_final_mnp_{id}.ovf in the MNP folder
+       (from older versions) is used if there is one. Every reader of step fields goes through this, so they all agree
+       on which file a step is.'''
+    info = read_manifest(mnp)['steps'].get(str(step))
+    filename = os.path.join(mnp.filepath, 'm_final_mnp_{}.ovf'.format(mnp.id))
+    if step == 0 and os.path.isfile(filename):
+        return info, filename
+    if info is not None and info.get('store') == 'h5':
+        return info, None
+    return info, os.path.join(mnp.filepath, 'drives', 'm_final_{}_mnp_{}.ovf'.format(step, mnp.id))
+
+
+def load_step_field(mnp, step):
+    '''loads the m_final field of a step of an MNP from the file step_file finds for it'''
+    info, filename = step_file(mnp, step)
+    if filename is not None:
+        return df.Field.fromfile(filename)
+    with open_store(mnp) as f:
+        return df.Field(store_mesh(f), dim=3, value=f[info['dataset']][...])
+
+
+def plane_slab(pmin, pmax, n, z):
+    '''returns the index of the layer of cells at height z in a mesh from pmin to pmax with n cells, and the plane mesh
+       at z that field.plane(z=z) would use for that mesh. The values of the layer are the values of the plane.'''
+    mesh = df.Mesh(p1=tuple(pmin), p2=tuple(pmax), n=tuple(int(i) for i in n))
+    plane = mesh.plane(z=z)
+    k = mesh.point2index(plane.index2point((0, 0, 0)))[2]  # the cell field.plane samples, even on a cell boundary
+    return k, plane
+
+
+def ovf_plane(filename, z):
+    '''reads the plane at height z from a binary OVF 2.0 file by memory mapping it, so only the cells of that plane
+       are read from disk. The result is the same as field.plane(z=z). Returns None if the file is in another
+       format.'''
+    header = {}
+    with open(filename, 'rb') as f:
+        line = f.readline().decode('latin1')
+        if not line.startswith('# OOMMF OVF 2.0'):
+            return None
+        while not line.startswith('# Begin: Data') and line:
+            key, _, value = line[1:].partition(':')
+            header[key.strip().lower()] = value.strip()
+            line = f.readline().decode('latin1')
+        offset = f.tell()
+    dtype, check = {'Binary 8': ('<f8', 123456789012345.0), 'Binary 4': ('<f4', 1234567.0)}.get(
+        line[len('# Begin: Data'):].strip(), (None, None))
+    if dtype is None or header.get('meshtype') != 'rectangular':
+        return None
+    if np.fromfile(filename, dtype=dtype, count=1, offset=offset)[0] != check:
+        return None
+    n = tuple(int(header[i + 'nodes']) for i in 'xyz')
+    dim = int(header['valuedim'])
+    pmin = tuple(float(header[i + 'min']) for i in 'xyz')
+    pmax = tuple(float(header[i + 'max']) for i in 'xyz')
+    k, plane = plane_slab(pmin, pmax, n, z)
+    itemsize = np.dtype(dtype).itemsize
+    values = np.memmap(filename, dtype=dtype, mode='r', offset=offset + itemsize * (1 + k * n[0] * n[1] * dim),
+                       shape=(n[1], n[0], dim))
+    return df.Field(plane, dim=dim, value=np.array(values, dtype=float).transpose(1, 0, 2)[:, :, np.newaxis, :])
+
+
+def load_step_plane(mnp, step, z):
+    '''returns the plane of the m_final field of a step at height z, like field.plane(z=z). Only the cells of that
+       plane are read from the run store or from a binary .ovf file.'''
+    info, filename = step_file(mnp, step)
+    if filename is not None:
+        plane = ovf_plane(filename, z)
+        if plane is None:
+            return load_step_field(mnp, step).plane(z=z)
+        return plane
+    with open_store(mnp) as f:
+        k, plane = plane_slab(f.attrs['pmin'], f.attrs['pmax'], f.attrs['n'], z)
+        return df.Field(plane, dim=3, value=f[info['dataset']][:, :, k:k + 1, :])
+
+
+def export_step_ovf(mnp, step, filename=None):
+    '''writes the m_final field of a step to an .ovf file (by default drives/m_final_{step}_mnp_{id}.ovf), for steps
+       saved in the run store that are needed by other programs. Returns the filename.'''
+    if filename is None:
+        filename = os.path.join(mnp.filepath, 'drives', 'm_final_{}_mnp_{}.ovf'.format(step, mnp.id))
+    load_step_field(mnp, step).write(filename)
+    return filename
 
 
 class MNP_MinDriver(mc.MinDriver):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-    def drive_mnp(self, mnp, make_json=True, **kwargs):
+    def drive_mnp(self, mnp, make_json=True, scratch=None, store=None, **kwargs):
+        '''drives an MNP with the default MNP_System. OOMMF is run in its own scratch directory (see scratch_dir), so
+           several drives can run in the same directory at once.'''
         drivepath = os.path.join(mnp.filepath, 'drives')
         if not os.path.isdir(drivepath):
             os.mkdir(drivepath)
         system = MNP_System(mnp)
         system.initialize()
-        self.drive(system, **kwargs)
-        mnp.save_any_field(system.m, field_name='m_final_{}'.format(how_many_m_finals(mnp)), filepath=drivepath)
-        if make_json:
-            self.drive_json(system, drivepath)
+        with scratch_dir(mnp, scratch) as dirname:
+            self.drive(system, dirname=dirname, **kwargs)
+        self.save_step(system, drivepath, make_json, store)
 
-    def drive_system(self, system, make_json=True, **kwargs):
+    def drive_system(self, system, make_json=True, scratch=None, store=None, **kwargs):
         drivepath = os.path.join(system.mnp.filepath, 'drives')
         if not os.path.isdir(drivepath):
             os.mkdir(drivepath)
-        self.drive(system, **kwargs)
-        system.mnp.save_any_field(system.m, field_name='m_final_{}'.format(how_many_m_finals(system.mnp)),
-                                  filepath=drivepath)
+        with scratch_dir(system.mnp, scratch) as dirname:
+            self.drive(system, dirname=dirname, **kwargs)
+        self.save_step(system, drivepath, make_json, store)
+
+    def save_step(self, system, drivepath, make_json=True, store=None):
+        '''saves the final magnetization of a drive as the next step of the MNP (see save_step_field) and records it in
+           the run manifest'''
+        step = allocate_steps(system.mnp)
+        info = save_step_field(system.mnp, system.m, step, store)
+        if hasattr(system.energy, 'zeeman'):
+            info.update(field_info(system.energy.zeeman.H))
+        record_step(system.mnp, step, driver='min', **info)
         if make_json:
-            self.drive_json(system, drivepath)
+            self.drive_json(system, drivepath, number=step + 1)
 
-    def drive_json(self, system, drivepath):
+    def drive_json(self, system, drivepath, number=None):
+        if number is None:
+            number = how_many_m_finals(system.mnp)
         Bx, By, Bz = system.energy.zeeman.H[0] * mm.consts.mu0, system.energy.zeeman.H[1] * mm.consts.mu0, \
                      system.energy.zeeman.H[2] * mm.consts.mu0
         drive_dict = {'Id': system.mnp.id,
@@ -757,10 +1441,10 @@ class MNP_MinDriver(mc.MinDriver):
                       'Bx': Bx,
                       'By': By,
                       'Bz': Bz,
-                      'Drive Number': how_many_m_finals(system.mnp),
+                      'Drive Number': number,
                       'Date': time.asctime()
                       }
-        with open(os.path.join(drivepath, 'drive_{}_info.json'.format(how_many_m_finals(system.mnp))),
+        with open(os.path.join(drivepath, 'drive_{}_info.json'.format(number)),
                   'w') as outfile:
             json.dump(drive_dict, outfile)
 
@@ -778,59 +1462,471 @@ class MNP_HysteresisDriver(mc.HysteresisDriver):
         super().__init__(**kwargs)
 
     def drive_hysteresis(self, mnp, Hmin=(0, 10, -1 / mm.consts.mu0), Hmax=(0, 0, 1 / mm.consts.mu0), n=10,
-                         **kwargs):
+                         checkpoint=False, native=False, system_name=None, scratch=None, store=None, **kwargs):
+        '''drives the MNP through the fields from make_h_list(Hmin, Hmax, n), starting each stage from the final
+           magnetization of the one before, and saves the table to hysteresis_data.csv. The energy terms are built
+           once and only the Zeeman field is changed between stages, but oommfc still writes the MIF file and the
+           material fields out again for every stage. If checkpoint is True, the m_final and table row
+           of each stage are saved as soon as the stage finishes, and a drive that was interrupted is resumed from its
+           last completed stage when it is run again with the same fields. If native is True, the whole loop is run
+           as one OOMMF hysteresis drive, so the material fields are only written out once. The setup, drive, and save
+           time of each stage are saved to hysteresis_timing.csv and kept in stage_times. store chooses how the m_final
+           fields are saved (see save_step_field).'''
+        if checkpoint and native:
+            raise AttributeError("checkpoint can't be used with native, since the native loop is a single OOMMF run")
         drivepath = os.path.join(mnp.filepath, 'drives')
         if not os.path.isdir(drivepath):
             os.mkdir(drivepath)
-        system = mm.System(name='DELETE')
+        system = mm.System(name='mnp_{}'.format(mnp.id) if system_name is None else system_name)
         M, A, K, U = mnp.maku()
         system.m = M
         data_rows = []
         h_list = make_h_list(Hmin, Hmax, n)
-        stage = 0
-        for h in h_list:
-            system.energy = mm.Demag() + mm.Exchange(A=A) + mm.UniaxialAnisotropy(K=K, u=U) + mm.Zeeman(H=h)
+        self.stage_times = []
+        checkpoint_file = os.path.join(mnp.filepath, 'hysteresis_checkpoint.csv')
+        first_step = None
+        if checkpoint:
+            data_rows, first_step = load_hysteresis_checkpoint(checkpoint_file, h_list)
+            if data_rows:
+                system.m = load_step_field(mnp, first_step + len(data_rows) - 1)
+                print('Resuming hysteresis at stage {} of {}'.format(len(data_rows), len(h_list)))
+        if first_step is None and (checkpoint or native):
+            first_step = allocate_steps(mnp, len(h_list))
+            if checkpoint:
+                save_hysteresis_checkpoint(checkpoint_file, data_rows, first_step, h_list)
+        system.energy = mm.Demag() + mm.Exchange(A=A) + mm.UniaxialAnisotropy(K=K, u=U)
+        if not native:
+            # the native drive applies the field schedule itself, so a Zeeman term would add a constant extra field
+            system.energy += mm.Zeeman(H=h_list[0])
+
+        with scratch_dir(mnp, scratch) as dirname:
+            if native:
+                t0 = time.time()
+                self.drive(system, dirname=dirname, Hmin=tuple(Hmin), Hmax=tuple(Hmax), n=n + 1, **kwargs)
+                t1 = time.time()
+                workingdir = os.path.join(dirname, system.name, 'drive-{}'.format(system.drive_number - 1))
+                omffiles = stage_magnetization_files(workingdir, system.name)
+                if len(omffiles) != len(h_list) or len(system.table.data) != len(h_list):
+                    raise ValueError('The OOMMF hysteresis drive returned {} stages instead of {}'.format(
+                        len(omffiles), len(h_list)))
+                for stage, h in enumerate(h_list):
+                    t2 = time.time()
+                    info = save_step_field(mnp, df.Field.fromfile(os.path.join(workingdir, omffiles[stage])),
+                                           first_step + stage, store)
+                    record_step(mnp, first_step + stage, driver='hysteresis', stage=stage, **info, **field_info(h))
+                    row = system.table.data.iloc[[stage]].copy()
+                    data_rows.append(hysteresis_row(row, stage, h))
+                    self.stage_times.append({'stage': stage, 'setup (s)': 0, 'drive (s)': (t1 - t0) / len(h_list),
+                                             'save (s)': time.time() - t2})
+
             md = mc.MinDriver()
-            md.drive(system, **kwargs)
-            mnp.save_any_field(system.m, field_name='m_final_{}'.format(how_many_m_finals(mnp)), filepath=drivepath)
-            system.table.data['stage'] = stage
-            stage += 1
-            system.table.data['B'] = np.linalg.norm(h) * mm.consts.mu0
-            system.table.data['Bx'] = h[0] * mm.consts.mu0
-            system.table.data['By'] = h[1] * mm.consts.mu0
-            system.table.data['Bz'] = h[2] * mm.consts.mu0
-            data_rows.append(system.table.data)
+            for stage in range(len(data_rows), len(h_list)):
+                t0 = time.time()
+                h = h_list[stage]
+                system.energy.zeeman.H = h
+                t1 = time.time()
+                md.drive(system, dirname=dirname, **kwargs)
+                t2 = time.time()
+                step = first_step + stage if checkpoint else allocate_steps(mnp)
+                info = save_step_field(mnp, system.m, step, store)
+                record_step(mnp, step, driver='hysteresis', stage=stage, **info, **field_info(h))
+                data_rows.append(hysteresis_row(system.table.data, stage, h))
+                if checkpoint:
+                    save_hysteresis_checkpoint(checkpoint_file, data_rows, first_step, h_list)
+                self.stage_times.append({'stage': stage, 'setup (s)': t1 - t0, 'drive (s)': t2 - t1,
+                                         'save (s)': time.time() - t2})
+                print('Stage {}: setup {:.3f} s, drive {:.3f} s, save {:.3f} s'.format(
+                    stage, *list(self.stage_times[-1].values())[1:]))
         table = pd.concat([data for data in data_rows])
         table.to_csv(os.path.join(mnp.filepath, 'hysteresis_data.csv'))
+        pd.DataFrame(self.stage_times).to_csv(os.path.join(mnp.filepath, 'hysteresis_timing.csv'), index=False)
+        if checkpoint:
+            os.remove(checkpoint_file)
         print('Hysteresis data saved to ', os.path.join(mnp.filepath, 'hysteresis_data.csv'))
 
+    def drive_adaptive_hysteresis(self, mnp, Hmin=(0, 10, -1 / mm.consts.mu0), Hmax=(0, 0, 1 / mm.consts.mu0),
+                                  threshold=0.1, min_step=0.01, max_step=0.2, max_stages=100, system_name=None,
+                                  scratch=None, store=None, **kwargs):
+        '''drives the MNP from Hmin to Hmax and back like drive_hysteresis, but chooses the field steps as it goes. Steps
+           are given as fractions of the distance from Hmin to Hmax. If the average magnetization changes by more than
+           threshold over a step, the stage is redone with half the step (down to min_step); if it changes by less than
+           a quarter of threshold, the next step is doubled (up to max_step). No more than max_stages stages are saved;
+           the steps are made longer if needed to finish the loop within that budget. The table saved to
+           hysteresis_data.csv has the fields that were actually applied.'''
+        drivepath = os.path.join(mnp.filepath, 'drives')
+        if not os.path.isdir(drivepath):
+            os.mkdir(drivepath)
+        hmin, hmax = np.array(Hmin, dtype=float), np.array(Hmax, dtype=float)
+        system = mm.System(name='mnp_{}'.format(mnp.id) if system_name is None else system_name)
+        M, A, K, U = mnp.maku()
+        system.m = M
+        system.energy = mm.Demag() + mm.Exchange(A=A) + mm.UniaxialAnisotropy(K=K, u=U) + mm.Zeeman(H=Hmin)
+        md = mc.MinDriver()
+        data_rows = []
+        self.stage_times = []
+
+        def run_stage(t):
+            t0 = time.time()
+            h = hmin + t * (hmax - hmin)
+            system.energy.zeeman.H = tuple(h)
+            md.drive(system, dirname=dirname, **kwargs)
+            self.stage_times.append({'stage': len(data_rows), 'field': t, 'setup (s)': 0,
+                                     'drive (s)': time.time() - t0, 'save (s)': 0})
+            return h, system.table.data[['mx', 'my', 'mz']].to_numpy()[-1]
+
+        def save_stage(h):
+            t0 = time.time()
+            step = allocate_steps(mnp)
+            info = save_step_field(mnp, system.m, step, store)
+            record_step(mnp, step, driver='adaptive hysteresis', stage=len(data_rows), **info, **field_info(h))
+            data_rows.append(hysteresis_row(system.table.data, len(data_rows), h))
+            self.stage_times[-1]['save (s)'] = time.time() - t0
+
+        with scratch_dir(mnp, scratch) as dirname:
+            h, m = run_stage(0)
+            save_stage(h)
+            t, step = 0, max_step
+            for end in (1, 0):
+                while t != end:
+                    remaining = abs(end - t) + (1 if end == 1 else 0)
+                    stages_left = max_stages - len(data_rows)
+                    if stages_left < 1:
+                        raise ValueError('max_stages is too small to finish the hysteresis loop')
+                    forced = max(remaining / stages_left, min_step)
+                    step = min(max(step, forced), abs(end - t))
+                    previous = system.m.array.copy()
+                    h, m_new = run_stage(t + step * (1 if end == 1 else -1))
+                    change = np.linalg.norm(m_new - m)
+                    if change > threshold and step > forced:
+                        system.m = df.Field(system.m.mesh, dim=3, value=previous)
+                        step = max(step / 2, forced)
+                        print('Field step refined to {:.4f}'.format(step))
+                        continue
+                    t = round(t + step * (1 if end == 1 else -1), 12)
+                    if abs(t - end) < 1e-9:
+                        t = end
+                    m = m_new
+                    save_stage(h)
+                    if change < threshold / 4:
+                        step = min(step * 2, max_step)
+        table = pd.concat(data_rows)
+        table.to_csv(os.path.join(mnp.filepath, 'hysteresis_data.csv'))
+        pd.DataFrame(self.stage_times).to_csv(os.path.join(mnp.filepath, 'hysteresis_timing.csv'), index=False)
+        print('Adaptive hysteresis with {} stages ({} drives) saved to '.format(len(data_rows), len(self.stage_times)),
+              os.path.join(mnp.filepath, 'hysteresis_data.csv'))
+
+
+def stage_magnetization_files(workingdir, system_name):
+    '''returns the magnetization files OOMMF saved at the end of each stage of a drive in workingdir, in stage order.
+       Other .omf files in the directory, such as the initial magnetization m0.omf, are ignored.'''
+    pattern = re.compile(re.escape(system_name) + r'-Oxs_MinDriver-Magnetization-(\d+)-(\d+)\.omf$')
+    stages = {}
+    for f in os.listdir(workingdir):
+        match = pattern.match(f)
+        if match:
+            stage, iteration = int(match.group(1)), int(match.group(2))
+            if stage not in stages or iteration > stages[stage][0]:
+                stages[stage] = (iteration, f)
+    return [stages[stage][1] for stage in sorted(stages)]
+
+
+def hysteresis_row(data, stage, h):
+    '''adds the stage and applied field columns to the table row of a hysteresis stage'''
+    data['stage'] = stage
+    data['B'] = np.linalg.norm(h) * mm.consts.mu0
+    data['Bx'] = h[0] * mm.consts.mu0
+    data['By'] = h[1] * mm.consts.mu0
+    data['Bz'] = h[2] * mm.consts.mu0
+    return data
+
+
+def save_hysteresis_checkpoint(filename, data_rows, first_step, h_list):
+    '''atomically saves a hysteresis checkpoint with a row for every stage: the table rows of the completed stages,
+       followed by pending rows with just the applied field. Each row has the step its m_final is saved as and whether
+       it is done, so the step numbers reserved for the drive are known from before the first stage is run.'''
+    pending = pd.DataFrame({'stage': range(len(data_rows), len(h_list)),
+                            'Bx': [h[0] * mm.consts.mu0 for h in h_list[len(data_rows):]],
+                            'By': [h[1] * mm.consts.mu0 for h in h_list[len(data_rows):]],
+                            'Bz': [h[2] * mm.consts.mu0 for h in h_list[len(data_rows):]]},
+                           index=[0] * (len(h_list) - len(data_rows)))
+    table = pd.concat(data_rows + [pending])
+    table['m_final'] = np.arange(first_step, first_step + len(h_list))
+    table['done'] = [1] * len(data_rows) + [0] * len(pending)
+    table.to_csv(filename + '.tmp')
+    os.replace(filename + '.tmp', filename)
+
+
+def load_hysteresis_checkpoint(filename, h_list):
+    '''returns the table rows of the completed stages from a hysteresis checkpoint and the step of the first stage's
+       m_final, or ([], None) if there is no checkpoint or it was saved for a different list of fields'''
+    if not os.path.isfile(filename):
+        return [], None
+    table = pd.read_csv(filename, index_col=0)
+    if len(table) != len(h_list) or 'done' not in table or \
+            not np.allclose(table[['Bx', 'By', 'Bz']].to_numpy(), np.array(h_list) * mm.consts.mu0):
+        print('Hysteresis checkpoint does not match these fields; starting over')
+        return [], None
+    first_step = int(table['m_final'].iloc[0])
+    table = table[table['done'] == 1].drop(columns=['m_final', 'done'])
+    return [table.iloc[[k]] for k in range(len(table))], first_step
+
+
+def hysteresis_job(mnp, kwargs):
+    '''runs the hysteresis drive of one MNP for hysteresis_pool and returns the time it took. The MNP is a geometry
+       copy, so its fields are loaded from the files saved by hysteresis_pool.'''
+    t0 = time.time()
+    mnp.m_field, mnp.a_field, mnp.k_field, mnp.u_field = mnp.load_fields()
+    mnp.initialized = True
+    MNP_HysteresisDriver().drive_hysteresis(mnp, **kwargs)
+    return time.time() - t0
+
+
+def hysteresis_pool(mnps, workers=None, checkpoint=True, **kwargs):
+    '''runs the hysteresis drives of several MNPs at the same time on a pool of worker processes (every available core
+       by default). The keyword arguments are passed to MNP_HysteresisDriver.drive_hysteresis. Returns a list with the
+       time each drive took, or the exception it raised. With checkpoint=True, running it again resumes any drives
+       that did not finish.'''
+    kwargs['checkpoint'] = checkpoint
+    for mnp in mnps:
+        mnp.save_fields()
+    results = []
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(hysteresis_job, mnp.geometry_copy(), kwargs) for mnp in mnps]
+        for mnp, future in zip(mnps, futures):
+            try:
+                results.append(future.result())
+                print('Hysteresis of MNP {} finished in {} s'.format(mnp.id, results[-1]))
+            except Exception as e:
+                results.append(e)
+                print('Hysteresis of MNP {} failed: {}'.format(mnp.id, e))
+    return results
+
 
 def quick_drive(mnp, **kwargs):
     md = MNP_MinDriver()
     md.drive_mnp(mnp, **kwargs)
 
 
+batch_errors = (TypeError, ValueError, AttributeError, NameError)  # bad arguments, which fail the same way every time
+
+
+def batch_job(spec, retries=1):
+    '''builds, drives, and analyzes one MNP for run_batch and returns a summary dictionary. spec is a dictionary of
+       arguments for MNP, plus the optional keys 'drive' ('min' (default), 'hysteresis', or 'adaptive'),
+       'drive_options' (a dictionary of arguments for the drive method), and 'analyze' (True by default). The
+       drivers run OOMMF in their own scratch directories, so jobs never share OOMMF files. A job that raises one of
+       batch_errors is not tried again, since those come from bad arguments.'''
+    spec = dict(spec)
+    drive = spec.pop('drive', 'min')
+    drive_options = spec.pop('drive_options', {})
+    analyze = spec.pop('analyze', True)
+    if 'directory' in spec:
+        spec['directory'] = os.path.abspath(spec['directory'])
+    summary = {'Id': spec.get('id'), 'Name': spec.get('name'), 'Drive': drive, 'Status': 'failed', 'Attempts': 0,
+               'Time (s)': None, 'Error': None}
+    if drive not in ('min', 'hysteresis', 'adaptive'):
+        summary['Error'] = repr(AttributeError("drive must be one of 'min', 'hysteresis', or 'adaptive'"))
+        print('MNP {} failed: {}'.format(summary['Id'], summary['Error']))
+        return summary
+    for attempt in range(retries + 1):
+        summary['Attempts'] = attempt + 1
+        t0 = time.time()
+        try:
+            mnp = MNP(**spec)
+            summary['Id'], summary['Name'] = mnp.id, mnp.name
+            mnp.initialize()
+            if drive == 'min':
+                MNP_MinDriver().drive_mnp(mnp, **drive_options)
+            elif drive == 'hysteresis':
+                MNP_HysteresisDriver().drive_hysteresis(mnp, **drive_options)
+            else:
+                MNP_HysteresisDriver().drive_adaptive_hysteresis(mnp, **drive_options)
+            if analyze:
+                analyzer = MNP_Domain_Analyzer(mnp, step=m_final_steps(mnp)[-1], preload_field=False)
+                if drive == 'min':
+                    analyzer.extract()
+                else:
+                    analyzer.extract_all_steps()
+                analyzer.find_regions()
+                analyzer.save_domains()
+            summary.update({'Status': 'done', 'Time (s)': time.time() - t0, 'Error': None})
+            return summary
+        except Exception as e:
+            summary.update({'Time (s)': time.time() - t0, 'Error': repr(e)})
+            print('MNP {} failed on attempt {}: {}'.format(summary['Id'], attempt + 1, repr(e)))
+            if isinstance(e, batch_errors):
+                break
+    return summary
+
+
+def assign_batch_ids(specs):
+    '''returns a copy of specs where every spec without an id (or with id -1) has the next free MNP id in its
+       directory. The ids are picked before the jobs start, since MNPs made at the same time with id -1 could pick the
+       same one.'''
+    defaults = inspect.signature(MNP).parameters
+    specs = [dict(spec) for spec in specs]
+    used = {}
+    for spec in specs:
+        dirpath = os.path.join(os.path.abspath(spec.get('directory', defaults['directory'].default)),
+                               spec.get('name', defaults['name'].default))
+        if dirpath not in used:
+            used[dirpath] = set(range(len(next(os.walk(dirpath))[1]))) if os.path.isdir(dirpath) else set()
+        spec['dirpath'] = dirpath
+        if spec.get('id', -1) != -1:
+            used[dirpath].add(spec['id'])
+    for spec in specs:
+        dirpath = spec.pop('dirpath')
+        if spec.get('id', -1) == -1:
+            spec['id'] = min(set(range(len(used[dirpath]) + 1)) - used[dirpath])
+            used[dirpath].add(spec['id'])
+    return specs
+
+
+def run_batch(specs, workers=None, retries=1, summary_file='batch_summary.csv'):
+    '''builds, initializes, drives, and analyzes many MNPs at the same time on a pool of worker processes (every
+       available core by default). Each spec is a dictionary as described in batch_job; specs without an id are
+       given one with assign_batch_ids. A job that fails is tried again up to retries more times. Returns a pandas
+       DataFrame with the status, number of attempts, time, and error of each job, in the order of specs, which is
+       also saved to summary_file unless it is None.'''
+    t0 = time.time()
+    specs = assign_batch_ids(specs)
+    summaries = [None] * len(specs)
+    with ProcessPoolExecutor(workers) as pool:
+        futures = {pool.submit(batch_job, spec, retries): i for i, spec in enumerate(specs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                summaries[i] = future.result()
+            except Exception as e:
+                # the job could not run or return at all, e.g. its worker process died
+                summaries[i] = {'Id': specs[i]['id'], 'Name': specs[i].get('name'),
+                                'Drive': specs[i].get('drive', 'min'), 'Status': 'failed', 'Attempts': 0,
+                                'Time (s)': None, 'Error': repr(e)}
+                print('MNP {} failed: {}'.format(specs[i]['id'], repr(e)))
+    summary = pd.DataFrame(summaries)
+    if summary_file is not None:
+        summary.to_csv(summary_file, index=False)
+    print('Batch of {} MNPs finished in {} s: {} done, {} failed'.format(
+        len(specs), time.time() - t0, sum(summary['Status'] == 'done'), sum(summary['Status'] != 'done')))
+    return summary
+
+
+def step_source(mnp, step):
+    '''returns a string that changes whenever the m_final field of a step is saved again: its run manifest entry, and
+       for .ovf files the size and modification time of the file. Returns None if the field can't be found.'''
+    info, filename = step_file(mnp, step)
+    if filename is None:
+        return json.dumps(info, sort_keys=True)
+    if not os.path.isfile(filename):
+        return None
+    stat = os.stat(filename)
+    return json.dumps([info, filename, stat.st_size, stat.st_mtime_ns], sort_keys=True)
+
+
+def artifact_index(path):
+    '''the index of the cached plots saved in a directory, a json file of the key each plot was made with'''
+    return os.path.join(path, 'artifacts.json')
+
+
+def read_artifacts(path):
+    if not os.path.isfile(artifact_index(path)):
+        return {}
+    with open(artifact_index(path)) as f:
+        return json.load(f)
+
+
+def write_artifacts(path, index):
+    tmp = '{}.{}.tmp'.format(artifact_index(path), os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, artifact_index(path))
+
+
+def artifact_current(filename, key):
+    '''returns True if filename was saved with this key and can be used as it is. If it was saved with a different
+       key, it is stale, so it is deleted and removed from the index.'''
+    path, name = os.path.split(os.path.abspath(filename))
+    with file_lock(artifact_index(path)):
+        index = read_artifacts(path)
+        if index.get(name) == key and os.path.isfile(filename):
+            return True
+        if name in index:
+            del index[name]
+            if os.path.isfile(filename):
+                os.remove(filename)
+            write_artifacts(path, index)
+    return False
+
+
+def record_artifact(filename, key):
+    '''records that filename was saved with this key'''
+    path, name = os.path.split(os.path.abspath(filename))
+    with file_lock(artifact_index(path)):
+        index = read_artifacts(path)
+        index[name] = key
+        write_artifacts(path, index)
+
+
+def prune_artifacts(path, keep):
+    '''deletes the cached plots in path that aren't in keep (a list of file names), such as plots of steps that no
+       longer exist'''
+    keep = set(os.path.basename(name) for name in keep)
+    with file_lock(artifact_index(path)):
+        index = read_artifacts(path)
+        for name in [name for name in index if name not in keep]:
+            del index[name]
+            if os.path.isfile(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+        write_artifacts(path, index)
+
+
 class MNP_Analyzer:
     def __init__(self, mnp, step=0, preload_field=True):
         self.mnp = mnp
         self.path = os.path.join(self.mnp.filepath, 'plots')
         self.step = step
+        self.centers_cache = None
+        self.field = None
+        self.loaded_field = None
         if not os.path.isdir(self.path):
             os.mkdir(self.path)
         if preload_field:
-            if step == 0 and os.path.isfile(os.path.join(self.mnp.filepath, 'm_final_mnp_{}.ovf'.format(self.mnp.id))):
-                self.field = self.mnp.load_any_field('m_final')
-            else:
-                self.field = self.mnp.load_any_field('m_final_{}'.format(step),
-                                                     filepath=os.path.join(self.mnp.filepath, 'drives'))
+            self.load_field()
+
+    def load_field(self):
+        '''loads the m_final field for the current step (see step_file)'''
+        self.field = load_step_field(self.mnp, self.step)
+        self.loaded_field = self.field
 
     def load_step(self, step):
         self.step = step
-        self.field = self.mnp.load_any_field('m_final_{}'.format(step),
-                                             filepath=os.path.join(self.mnp.filepath, 'drives'))
+        self.centers_cache = None
+        self.field = load_step_field(self.mnp, step)
+        self.loaded_field = self.field
+
+    def load_plane(self, z_plane=0):
+        '''returns the z_plane plane of the m_final field for the current step. If the field has not been loaded, only
+           that plane is read from the file of the step (see load_step_plane), so the plots only need memory for one
+           plane.'''
+        if self.field is None:
+            return load_step_plane(self.mnp, self.step, z_plane)
+        return self.field.plane(z=z_plane)
+
+    def artifact_key(self, plot, ax=None, save=True, cache=True, **params):
+        '''returns the key a saved plot is cached under: a hash of the plot type, its parameters, and the m_final file
+           of the current step (see step_source). Returns None if the plot can't be cached because it is drawn on an
+           existing ax, isn't saved, cache is False, or the field was set by hand instead of loaded from a step.'''
+        if ax is not None or not save or not cache:
+            return None
+        if self.field is not None and self.field is not self.loaded_field:
+            return None
+        source = step_source(self.mnp, self.step)
+        if source is None:
+            return None
+        return hashlib.sha256(repr((source, plot, sorted(params.items()))).encode()).hexdigest()
 
     def xy_plot(self, ax=None, title=None, z_plane=0, figsize=(50, 50), filename=None, filetype=None,
-                scalar_cmap='hsv', vector_cmap='binary', scalar_clim=(0, 6.28), **kwargs):
+                scalar_cmap='hsv', vector_cmap='binary', scalar_clim=(0, 6.28), save=True, cache=True, **kwargs):
         if filetype is None:  # filetype defautls to .png
             filetype = 'png'
         if filename is None:
@@ -838,22 +1934,31 @@ class MNP_Analyzer:
             filename = os.path.join(self.path, thefilename)
         if title is None:
             title = 'MNP {} XY Plot'.format(self.mnp.id)
+        key = self.artifact_key('xy_plot', ax, save, cache, title=title, z_plane=z_plane, figsize=figsize,
+                                filename=filename, scalar_cmap=scalar_cmap, vector_cmap=vector_cmap,
+                                scalar_clim=scalar_clim, **kwargs)
+        if key is not None and artifact_current(filename, key):
+            return None
         if ax is None:
             fig = plt.figure(figsize=figsize)
             ax = fig.add_subplot(111)
 
             ax.set_title(title)
-        self.field.orientation.plane(z=z_plane).mpl(ax=ax, figsize=figsize,
-                                                    scalar_field=self.field.orientation.plane(z=z_plane).angle,
-                                                    vector_color_field=self.field.orientation.z,
-                                                    vector_color=True,
-                                                    vector_colorbar=True, scalar_cmap=scalar_cmap,
-                                                    vector_cmap=vector_cmap,
-                                                    scalar_clim=scalar_clim,
-                                                    filename=filename, **kwargs)
+        plane = self.load_plane(z_plane).orientation
+        plane.mpl(ax=ax, figsize=figsize,
+                  scalar_field=plane.angle,
+                  vector_color_field=plane.z,
+                  vector_color=True,
+                  vector_colorbar=True, scalar_cmap=scalar_cmap,
+                  vector_cmap=vector_cmap,
+                  scalar_clim=scalar_clim,
+                  filename=filename if save else None, **kwargs)
+        if key is not None:
+            record_artifact(filename, key)
+        return ax.figure
 
     def z_plot(self, ax=None, title=None, z_plane=0, figsize=(50, 50), filename=None, filetype=None,
-               scalar_cmap='viridis', **kwargs):
+               scalar_cmap='viridis', save=True, cache=True, **kwargs):
         if filetype is None:  # filetype defautls to .png
             filetype = 'png'
         if filename is None:
@@ -861,16 +1966,24 @@ class MNP_Analyzer:
             filename = os.path.join(self.path, thefilename)
         if title is None:
             title = 'MNP {} Z Plot'.format(self.mnp.id)
+        key = self.artifact_key('z_plot', ax, save, cache, title=title, z_plane=z_plane, figsize=figsize,
+                                filename=filename, scalar_cmap=scalar_cmap, **kwargs)
+        if key is not None and artifact_current(filename, key):
+            return None
         if ax is None:
             fig = plt.figure(figsize=figsize)
             ax = fig.add_subplot(111)
 
             ax.set_title(title)
-        self.field.orientation.plane(z=z_plane).mpl(ax=ax, figsize=figsize,
-                                                    filename=filename, scalar_cmap=scalar_cmap, **kwargs)
+        self.load_plane(z_plane).orientation.mpl(ax=ax, figsize=figsize,
+                                                 filename=filename if save else None, scalar_cmap=scalar_cmap,
+                                                 **kwargs)
+        if key is not None:
+            record_artifact(filename, key)
+        return ax.figure
 
     def xy_scalar_plot(self, ax=None, title=None, z_plane=0, figsize=(40, 10), filename=None, filetype=None,
-                       cmap='hsv', clim=(0, 6.28), **kwargs):
+                       cmap='hsv', clim=(0, 6.28), save=True, cache=True, **kwargs):
         if filetype is None:  # filetype defautls to .png
             filetype = 'png'
         if filename is None:
@@ -878,18 +1991,26 @@ class MNP_Analyzer:
             filename = os.path.join(self.path, thefilename)
         if title is None:
             title = 'MNP {} XY Scalar Plot'.format(self.mnp.id)
+        key = self.artifact_key('xy_scalar_plot', ax, save, cache, title=title, z_plane=z_plane, figsize=figsize,
+                                filename=filename, cmap=cmap, clim=clim, **kwargs)
+        if key is not None and artifact_current(filename, key):
+            return None
         if ax is None:
             fig = plt.figure(figsize=figsize)
             ax = fig.add_subplot(111)
 
             ax.set_title(title)
-        self.field.orientation.plane(z=z_plane).angle.mpl_scalar(ax=ax,
-                                                                 filename=filename,
-                                                                 figsize=figsize, filter_field=self.field.x,
-                                                                 cmap=cmap, clim=clim, **kwargs)
+        plane = self.load_plane(z_plane)
+        plane.orientation.angle.mpl_scalar(ax=ax,
+                                           filename=filename if save else None,
+                                           figsize=figsize, filter_field=plane.x,
+                                           cmap=cmap, clim=clim, **kwargs)
+        if key is not None:
+            record_artifact(filename, key)
+        return ax.figure
 
     def z_scalar_plot(self, ax=None, title=None, z_plane=0, figsize=(40, 10), filename=None, filetype=None,
-                      cmap='viridis', **kwargs):
+                      cmap='viridis', save=True, cache=True, **kwargs):
         if filetype is None:  # filetype defautls to .png
             filetype = 'png'
         if filename is None:
@@ -897,41 +2018,109 @@ class MNP_Analyzer:
             filename = os.path.join(self.path, thefilename)
         if title is None:
             title = 'MNP {} Z Scalar Plot'.format(self.mnp.id)
+        key = self.artifact_key('z_scalar_plot', ax, save, cache, title=title, z_plane=z_plane, figsize=figsize,
+                                filename=filename, cmap=cmap, **kwargs)
+        if key is not None and artifact_current(filename, key):
+            return None
         if ax is None:
             fig = plt.figure(figsize=figsize)
             ax = fig.add_subplot(111)
 
             ax.set_title(title)
-        self.field.orientation.plane(z=z_plane).z.mpl_scalar(ax=ax,
-                                                             filename=filename,
-                                                             figsize=figsize, filter_field=self.field.x,
-                                                             cmap=cmap, **kwargs)
-
-    def extract(self):
+        plane = self.load_plane(z_plane)
+        plane.orientation.z.mpl_scalar(ax=ax,
+                                       filename=filename if save else None,
+                                       figsize=figsize, filter_field=plane.x,
+                                       cmap=cmap, **kwargs)
+        if key is not None:
+            record_artifact(filename, key)
+        return ax.figure
+
+    def extract(self, core=False, save_csv=False):
+        '''saves the position, normalized magnetization (mx, my, mz), and in-plane angle at the center of each MNP.
+           The field is normalized once and the values are read straight out of its array at the cell containing each
+           center. If core is True, the normalized magnetization is instead averaged over all of the cells in the core
+           of each MNP (falling back to the center cell for cores too small to contain a cell center). The data is saved
+           in binary to centers_data_{step}.npz, and also to centers_data_{step}.csv if save_csv is True.'''
         t0 = time.time()
-        print("Extracting center magnetization values...")
+        if self.field is None:
+            self.load_field()
+        print("Extracting center magnetization values for step {}...".format(self.step))
         x, y, z = self.mnp.scaled_coords[:, 0], self.mnp.scaled_coords[:, 1], self.mnp.scaled_coords[:, 2]
-        mx = []
-        my = []
-        mz = []
-        angle = []
-        for point in self.mnp.scaled_coords:
-            h, j, k = point
-            mx.append(self.field.orientation.line(p1=(point), p2=(0, 0, 0), n=2).data.vx[0]),
-            my.append(self.field.orientation.line(p1=(point), p2=(0, 0, 0), n=2).data.vy[0]),
-            mz.append(self.field.orientation.line(p1=(point), p2=(0, 0, 0), n=2).data.vz[0])
-            angle.append(self.field.plane(z=k).angle.line(p1=point, p2=(0, 0, k), n=2).data.v[0])
-        table = np.column_stack((x, y, z, mx, my, mz, angle))
-        table.tofile(os.path.join(self.mnp.filepath, 'centers_data.csv'), sep=',')
+        mesh = self.field.mesh
+        index = np.subtract(np.divide(np.subtract(self.mnp.scaled_coords, mesh.region.pmin), mesh.cell), 0.5)
+        index = np.clip(index.round().astype(int), 0, np.subtract(mesh.n, 1))
+        index = tuple(index.T)
+        array = self.field.array
+        orientation = self.field.orientation.array
+        m = orientation[index]
+        v = array[index]
+        if core:
+            if self.mnp.region_labels is None:
+                self.mnp.label_mesh()
+            in_core = self.mnp.region_labels == 2
+            spheres = self.mnp.sphere_index[in_core]
+            counts = np.bincount(spheres, minlength=len(m))
+            has_core = counts > 0
+            for c in range(3):
+                total = np.bincount(spheres, weights=orientation[in_core][:, c], minlength=len(m))
+                m[has_core, c] = total[has_core] / counts[has_core]
+            v = np.where(has_core[:, np.newaxis], m, v)
+        angle = np.arctan2(v[:, 1], v[:, 0])
+        angle[angle < 0] += 2 * np.pi
+        table = np.column_stack((x, y, z, m[:, 0], m[:, 1], m[:, 2], angle))
+        np.savez(self.centers_file, **dict(zip(centers_columns, table.T)))
+        if save_csv:
+            self.export_centers_csv()
+        self.centers_cache = table
         print('Values extracted in {} s'.format(time.time()-t0))
 
+    def extract_all_steps(self, core=False, save_csv=False):
+        '''extracts the center data of every m_final step in the drives directory, loading each field once. Returns the
+           list of steps. The analyzer is left on the step it was on before.'''
+        step, field, loaded_field = self.step, self.field, self.loaded_field
+        steps = m_final_steps(self.mnp)
+        for n in steps:
+            self.load_step(n)
+            self.extract(core=core, save_csv=save_csv)
+            self.field = None
+        self.step, self.field, self.loaded_field, self.centers_cache = step, field, loaded_field, None
+        return steps
+
+    @property
+    def centers_file(self):
+        '''the file that extract saves the center data of the current step to'''
+        return os.path.join(self.mnp.filepath, 'centers_data_{}.npz'.format(self.step))
+
+    def centers_data(self):
+        '''returns the center data as an (n, 7) array with the columns x, y, z, mx, my, mz, and angle. It is read from
+           the file saved by extract (extracting it first if there is none) the first time it is needed and then kept
+           in memory. Each step has its own file. For step 0, a centers_data.csv from an older version is used if there
+           is no binary file.'''
+        if self.centers_cache is None:
+            csv_file = os.path.join(self.mnp.filepath, 'centers_data.csv')
+            if os.path.isfile(self.centers_file):
+                with np.load(self.centers_file) as data:
+                    self.centers_cache = np.column_stack([data[c] for c in centers_columns])
+            elif self.step == 0 and os.path.isfile(csv_file):
+                with open(csv_file) as f:
+                    header = f.read(1) == 'x'
+                self.centers_cache = np.genfromtxt(csv_file, delimiter=',', skip_header=int(header)).reshape(-1, 7)
+            else:
+                self.extract()
+        return self.centers_cache
+
+    def export_centers_csv(self, filename=None):
+        '''saves the center data of the current step as a csv file with a header row (centers_data_{step}.csv in the MNP
+           folder by default)'''
+        if filename is None:
+            filename = os.path.join(self.mnp.filepath, 'centers_data_{}.csv'.format(self.step))
+        np.savetxt(filename, self.centers_data(), delimiter=',', header=','.join(centers_columns), comments='')
+
     def mpl_center_vectors(self, color_field='z', ax=None, title=None, x_label=None, y_label=None, figsize=None,
                            filename=None,
                            filetype=None, **kwargs):
-        if not os.path.isfile(os.path.join(self.mnp.filepath, 'centers_data.csv')):
-            self.extract()
-        data = np.genfromtxt(os.path.join(self.mnp.filepath, 'centers_data.csv'), delimiter=',')
-        data = data.reshape(-1, 7)
+        data = self.centers_data()
 
         if figsize is None:
             figsize = (50, 50)
@@ -972,10 +2161,7 @@ class MNP_Analyzer:
             7.0, -5.0, 5.0, 0.0,
             0.0, 0.0, 0.0, 1.0
         ]
-        if not os.path.isfile(os.path.join(self.mnp.filepath, 'centers_data.csv')):
-            self.extract()
-        data = np.genfromtxt(os.path.join(self.mnp.filepath, 'centers_data.csv'), delimiter=',')
-        data = data.reshape(-1, 7)
+        data = self.centers_data()
         center_magnetization = np.column_stack((data[:, 3], data[:, 4], data[:, 5]))
         origins = self.mnp.coord_list.astype(np.float32)
         origins[:, 0] *= scale[0]
@@ -1048,107 +2234,192 @@ class MNP_Hysteresis_Analyzer(MNP_Analyzer):
         plt.legend(y)
         plt.savefig(fname=filename)
 
+    def step_plot(self, step, type='xy', z_plane=0, figsize=(50, 50), filename=None, scalar_cmap=None,
+                  vector_cmap=None, scalar_clim=None, **kwargs):
+        '''makes the type plot ('xy', 'z', 'xy_scalar', or 'z_scalar') of one hysteresis step, reading only the
+           z_plane plane of its field, and returns the figure. The plot is saved to filename if one is given, and
+           isn't made again (None is returned) if filename is already up to date (see MNP_Analyzer.artifact_key).'''
+        if type not in hyst_plot_types:
+            raise AttributeError("type must be 'xy', 'z', 'xy_scalar', or 'z_scalar', not {}".format(type))
+        self.step, self.field = step, None
+        title = 'MNP {} {} Step {}'.format(self.mnp.id, hyst_plot_types[type][1], step)
+        save = filename is not None
+        if type == 'xy':
+            return self.xy_plot(title=title, z_plane=z_plane, figsize=figsize, filename=filename, save=save,
+                                scalar_cmap=scalar_cmap or 'hsv', vector_cmap=vector_cmap or 'binary',
+                                scalar_clim=scalar_clim or (0, 6.28), **kwargs)
+        elif type == 'z':
+            return self.z_plot(title=title, z_plane=z_plane, figsize=figsize, filename=filename, save=save,
+                               scalar_cmap=scalar_cmap or 'viridis', scalar_clim=scalar_clim or (-1, 1), **kwargs)
+        elif type == 'xy_scalar':
+            return self.xy_scalar_plot(title=title, z_plane=z_plane, figsize=figsize, filename=filename, save=save,
+                                       cmap=scalar_cmap or 'hsv', clim=scalar_clim or (0, 6.28), **kwargs)
+        elif type == 'z_scalar':
+            return self.z_scalar_plot(title=title, z_plane=z_plane, figsize=figsize, filename=filename, save=save,
+                                      cmap=scalar_cmap or 'viridis', clim=scalar_clim or (-1, 1), **kwargs)
+
+    def render_steps(self, type='xy', workers=None, savepath=None, frame_size=None, **kwargs):
+        '''renders the type plot of every hysteresis step with render_frame on a pool of workers processes (by default
+           every available core) and yields (step, frame) in step order as the frames are finished. The plots are
+           saved to savepath if it is given, where plots that are already up to date are not made again and plots of
+           steps that no longer exist are deleted. frame is the plot as a BGR image of frame_size (width, height)
+           pixels, or None if frame_size is None. At most workers steps are outstanding at a time, so only that many
+           frames are ever held in memory.'''
+        steps = m_final_steps(self.mnp)
+        jobs = [(step, None if savepath is None else
+                 os.path.join(savepath, '{}_{}.png'.format(hyst_plot_types[type][0], step))) for step in steps]
+        if savepath is not None:
+            prune_artifacts(savepath, [filename for step, filename in jobs])
+        print('Plotting...')
+        if workers == 1:
+            results = (render_frame(self.mnp, step, type, filename, frame_size, kwargs) for step, filename in jobs)
+            for i, (step, frame) in enumerate(zip(steps, results)):
+                print('\r' + "|{}{}| {}/{}".format('-' * i + '>', ' ' * (len(steps) - i - 1), i + 1, len(steps)),
+                      end='')
+                yield step, frame
+            print('\r')
+            return
+        workers = os.cpu_count() if workers is None else workers
+        mnp = self.mnp.geometry_copy()
+        with ProcessPoolExecutor(workers, initializer=matplotlib.use, initargs=('Agg',)) as executor:
+            # the steps are submitted lazily: workers at first, then one more each time one is taken out
+            futures = ((step, executor.submit(render_frame, mnp, step, type, filename, frame_size, kwargs))
+                       for step, filename in jobs)
+            pending = collections.deque(itertools.islice(futures, workers))
+            for i in range(len(steps)):
+                step, future = pending.popleft()
+                frame = future.result()
+                pending.extend(itertools.islice(futures, 1))
+                print('\r' + "|{}{}| {}/{}".format('-' * i + '>', ' ' * (len(steps) - i - 1), i + 1, len(steps)),
+                      end='')
+                yield step, frame
+        print('\r')
+
     def hyst_steps_plot(self, type='xy', name=None, ax=None, title=None, z_plane=0, figsize=(50, 50), filename=None,
                         filetype=None,
-                        scalar_cmap=None, vector_cmap=None, scalar_clim=None, **kwargs):
+                        scalar_cmap=None, vector_cmap=None, scalar_clim=None, workers=None, **kwargs):
+        '''saves the type plot of every hysteresis step to plots/{name}, rendering the steps on a pool of workers
+           processes (see render_steps). Every step gets its own figure, title, and png file, so ax, title, filename,
+           and filetype can't be given.'''
+        if any(arg is not None for arg in (ax, title, filename, filetype)):
+            raise AttributeError('ax, title, filename, and filetype cannot be given to hyst_steps_plot, since every '
+                                 'step is saved to its own png file in plots/{name}')
         if name is None:
             name = type + '_hysteresis_plot'
         savepath = os.path.join(self.path, name)
         if not os.path.isdir(savepath):
             os.mkdir(savepath)
-        print('Plotting...')
-        max = how_many_m_finals(self.mnp)
-        for n in range(max):
-            print('\r' + "|{}{}| {}/{}".format('-' * (n) + '>', ' ' * (max - n - 1), n + 1, max), end='')
-            self.field = self.mnp.load_any_field('m_final_{}'.format(n),
-                                                 filepath=os.path.join(self.mnp.filepath, 'drives'))
-            if type == 'xy':
-                title = 'MNP {} XY Plot Step {}'.format(self.mnp.id, n)
-                filename = os.path.join(savepath, 'xy_plot_{}.png'.format(n))
-                if scalar_cmap is None:
-                    scalar_cmap = 'hsv'
-                if vector_cmap is None:
-                    vector_cmap = 'binary'
-                if scalar_clim is None:
-                    scalar_clim = (0, 6.28)
-                self.xy_plot(title=title, ax=ax, z_plane=z_plane, figsize=figsize, filename=filename,
-                             filetype=filetype,
-                             scalar_cmap=scalar_cmap, vector_cmap=vector_cmap, scalar_clim=scalar_clim, **kwargs)
-            elif type == 'z':
-                title = 'MNP {} Z Plot Step {}'.format(self.mnp.id, n)
-                filename = os.path.join(savepath, 'z_plot_{}.png'.format(n))
-                if scalar_cmap is None:
-                    scalar_cmap = 'viridis'
-                if scalar_clim is None:
-                    scalar_clim = (-1, 1)
-                self.z_plot(title=title, ax=ax, z_plane=z_plane, figsize=figsize, filename=filename,
-                            filetype=filetype,
-                            scalar_cmap=scalar_cmap, scalar_clim=scalar_clim, **kwargs)
-            elif type == 'xy_scalar':
-                title = 'MNP {} XY Scalar Plot Step {}'.format(self.mnp.id, n)
-                filename = os.path.join(savepath, 'xy_scalar_plot_{}.png'.format(n))
-                if scalar_cmap is None:
-                    scalar_cmap = 'hsv'
-                if scalar_clim is None:
-                    scalar_clim = (0, 6.28)
-                self.xy_scalar_plot(title=title, ax=ax, z_plane=z_plane, figsize=figsize, filename=filename,
-                                    filetype=filetype,
-                                    cmap=scalar_cmap, clim=scalar_clim, **kwargs)
-            elif type == 'z_scalar':
-                title = 'MNP {} Z Scalar Plot Step {}'.format(self.mnp.id, n)
-                filename = os.path.join(savepath, 'z_scalar_plot_{}.png'.format(n))
-                if scalar_cmap is None:
-                    scalar_cmap = 'viridis'
-                if scalar_clim is None:
-                    scalar_clim = (-1, 1)
-                self.z_scalar_plot(ax=ax, title=title, z_plane=z_plane, figsize=figsize, filename=filename,
-                                   filetype=filetype,
-                                   cmap=scalar_cmap, scalar_clim=scalar_clim, **kwargs)
-        print('\r')
-
-    def hyst_movie(self, type='z', movie_name=None, name=None, **kwargs):
+        for step, frame in self.render_steps(type, workers, savepath, z_plane=z_plane, figsize=figsize,
+                                             scalar_cmap=scalar_cmap, vector_cmap=vector_cmap,
+                                             scalar_clim=scalar_clim, **kwargs):
+            pass
+
+    def hyst_movie(self, type='z', movie_name=None, name=None, workers=None, png=False, frame_size=(1080, 1080),
+                   **kwargs):
+        '''makes a movie of the type plot of every hysteresis step. The frames are rendered on a pool of workers
+           processes at frame_size (width, height) pixels and written to the movie in order as they are finished, so
+           a frame never needs the memory of a full size figure. If png is True, the plots are also saved
+           to plots/{name} like hyst_steps_plot. The movie isn't made again if none of the steps or arguments have
+           changed since it was last made.'''
         if movie_name is None:
             movie_name = os.path.join(self.path, '{}_hysteresis.mp4'.format(type))
+        key = None
+        if kwargs.get('cache', True):
+            sources = [step_source(self.mnp, step) for step in m_final_steps(self.mnp)]
+            key = hashlib.sha256(repr((sources, type, png, tuple(frame_size),
+                                       sorted(kwargs.items()))).encode()).hexdigest()
+            if artifact_current(movie_name, key):
+                print('Movie is up to date: ' + movie_name)
+                return
         if name is None:
-            if type == 'xy':
-                name = 'xy_hysteresis_plot'
-            elif type == 'z':
-                name = 'z_hysteresis_plot'
-            elif type == 'xy_scalar':
-                name = 'xy_scalar_hysteresis_plot'
-            elif type == 'z_scalar':
-                name = 'z_scalar_hysteresis_plot'
-        findpath = os.path.join(self.path, name)
-        if not os.path.isdir(findpath):
-            self.hyst_steps_plot(type=type, name=name, **kwargs)
+            name = type + '_hysteresis_plot'
+        savepath = None
+        if png:
+            savepath = os.path.join(self.path, name)
+            if not os.path.isdir(savepath):
+                os.mkdir(savepath)
         fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        images = []
-        for n in range(how_many_m_finals(self.mnp)):
-            if type == 'xy':
-                images.append(os.path.join(findpath, 'xy_plot_{}.png'.format(n)))
-            if type == 'z':
-                images.append(os.path.join(findpath, 'z_plot_{}.png'.format(n)))
-            if type == 'xy_scalar':
-                images.append(os.path.join(findpath, 'xy_scalar_plot_{}.png'.format(n)))
-            if type == 'z_scalar':
-                images.append(os.path.join(findpath, 'z_scalar_plot_{}.png'.format(n)))
-        frame = cv2.imread(images[0])
-        height, width, layers = frame.shape
-        video = cv2.VideoWriter(movie_name, fourcc, 1.0, (width, height))
-        dim = (int(width), int(height))
-        for image in images:
-            frame = cv2.imread(image)
-            frame = cv2.resize(frame, dim)
+        video = None
+        for step, frame in self.render_steps(type, workers, savepath, frame_size, **kwargs):
+            if video is None:
+                video = cv2.VideoWriter(movie_name, fourcc, 1.0, tuple(frame_size))
             video.write(frame)
-        cv2.destroyAllWindows()
+        if video is None:
+            raise ValueError('MNP {} has no hysteresis steps to make a movie of'.format(self.mnp.id))
         video.release()
+        if key is not None:
+            record_artifact(movie_name, key)
         print('Movie saved to ' + movie_name)
 
 
+# the file name prefix and title of each kind of hysteresis step plot
+hyst_plot_types = {'xy': ('xy_plot', 'XY Plot'), 'z': ('z_plot', 'Z Plot'),
+                   'xy_scalar': ('xy_scalar_plot', 'XY Scalar Plot'), 'z_scalar': ('z_scalar_plot', 'Z Scalar Plot')}
+
+
+def render_frame(mnp, step, type, filename, frame_size, kwargs):
+    '''makes the type plot of one hysteresis step for render_steps and closes its figure. Unless frame_size is None,
+       returns the plot as a BGR array for cv2 of frame_size (width, height) pixels. It is rasterized from the figure
+       at the dpi that makes it frame_size wide, or read back from filename and resized if the plot was already up to
+       date and so wasn't made again.'''
+    fig = MNP_Hysteresis_Analyzer(mnp).step_plot(step, type, filename=filename, **kwargs)
+    try:
+        if frame_size is None:
+            return None
+        if fig is None:
+            return cv2.resize(cv2.imread(filename), tuple(frame_size), interpolation=cv2.INTER_AREA)
+        fig.set_dpi(frame_size[0] / fig.get_figwidth())
+        fig.canvas.draw()
+        frame = cv2.cvtColor(np.asarray(fig.canvas.buffer_rgba()), cv2.COLOR_RGBA2BGR)
+        return cv2.resize(frame, tuple(frame_size), interpolation=cv2.INTER_AREA)
+    finally:
+        if fig is not None:
+            plt.close(fig)
+
+
+centers_columns = ('x', 'y', 'z', 'mx', 'my', 'mz', 'angle')
+
+
 def angle_finder(point, d_theta, d_phi):
     x, y, z = point
-    return [((np.math.acos(z / np.math.sqrt(x ** 2 + y ** 2 + z ** 2)) * 180 / np.pi)+d_theta)%180,
-            ((np.math.atan2(y, x) * 180 / np.pi)+180+d_phi)%360]
+    return [((math.acos(z / math.sqrt(x ** 2 + y ** 2 + z ** 2)) * 180 / np.pi)+d_theta)%180,
+            ((math.atan2(y, x) * 180 / np.pi)+180+d_phi)%360]
+
+
+# region_table[theta bin, phi bin] is the index (1 to 24) of the discretized region of the sphere
+region_table = np.zeros((6, 6), dtype=np.int8)
+for _theta_bin, _first, _n_phi in ((2, 1, 6), (3, 7, 6), (1, 13, 4), (4, 17, 4), (0, 21, 2), (5, 23, 2)):
+    region_table[_theta_bin, :_n_phi] = np.arange(_first, _first + _n_phi)
+
+
+def discretize_magnetization(m, d_theta=0, d_phi=0):
+    '''returns the index (1 to 24) of the region of the sphere that each of an (n, 3) array of magnetization vectors
+       points into, as an int8 array, with the regions offset by d_theta and d_phi degrees. d_theta and d_phi can
+       also be arrays of k offsets, in which case a (k, n) array is returned with a row for each offset. The
+       result is identical to binning the angles from angle_finder() one vector at a time.'''
+    m = np.asarray(m, dtype=float).reshape(-1, 3)
+    d_theta, d_phi = np.broadcast_arrays(np.asarray(d_theta, dtype=float), np.asarray(d_phi, dtype=float))
+    x, y, z = m[:, 0], m[:, 1], m[:, 2]
+    theta = (np.arccos(z / np.sqrt(x ** 2 + y ** 2 + z ** 2)) * 180 / np.pi + d_theta[..., np.newaxis]) % 180
+    phi = (np.arctan2(y, x) * 180 / np.pi + 180 + d_phi[..., np.newaxis]) % 360
+
+    # np.arccos and np.arctan2 can differ from math.acos and math.atan2 in the last bit, which only matters right
+    # at a region boundary (every boundary is a multiple of 30 degrees), so those few angles are redone exactly
+    near = (np.abs(theta / 30 - np.round(theta / 30)) < 1e-9) | (np.abs(phi / 30 - np.round(phi / 30)) < 1e-9)
+    for k, i in zip(*np.nonzero(near.reshape(-1, len(m)))):
+        theta.reshape(-1, len(m))[k, i], phi.reshape(-1, len(m))[k, i] = angle_finder(
+            m[i].tolist(), d_theta.reshape(-1)[k].item(), d_phi.reshape(-1)[k].item())
+
+    theta_bins = np.digitize(theta, [180 * i / 6 for i in range(1, 7)], right=True)
+    phi_bins = np.select([(theta_bins == 0) | (theta_bins == 5), (theta_bins == 1) | (theta_bins == 4)],
+                         [np.digitize(phi, [180, 360], right=True), np.digitize(phi, [90, 180, 270, 360], right=True)],
+                         np.digitize(phi, [60, 120, 180, 240, 300, 360], right=True))
+    return region_table[theta_bins, phi_bins]
+
+
+def orientation_domains(indptr, indices, region_indices):
+    '''returns the domain sizes for one orientation of the discretized regions; used by save_averaged_data'''
+    return domain_sizes(domain_labels(indptr, indices, region_indices))
 
 
 class MNP_Domain_Analyzer(MNP_Analyzer):
@@ -1156,67 +2427,23 @@ class MNP_Domain_Analyzer(MNP_Analyzer):
         super().__init__(mnp, step, preload_field)
 
         self.region_list = None
+        self.domain_labels = None
+        self.region_cache = {}
         self.d_theta = d_theta
         self.d_phi = d_phi
 
     @property
     def discretized_cmag(self):
-        if not os.path.isfile(os.path.join(self.mnp.filepath, 'centers_data.csv')):
-            self.extract()
-        data = np.genfromtxt(os.path.join(self.mnp.filepath, 'centers_data.csv'), delimiter=',')
-        data = data.reshape(-1, 7)
-        center_magnetization = np.column_stack((data[:, 3], data[:, 4], data[:, 5]))
+        '''the index (1 to 24) of the discretized region of the sphere that the magnetization of each MNP points into,
+           as an int8 array. It is calculated once for each step, d_theta, and d_phi and then cached.'''
+        key = (self.step, self.d_theta, self.d_phi)
+        if key not in self.region_cache:
+            self.region_cache[key] = discretize_magnetization(self.center_magnetization(), self.d_theta, self.d_phi)
+        return self.region_cache[key]
 
-        theta_list = []
-        phi_list = []
-        for point in center_magnetization:
-            theta, phi = angle_finder(point, self.d_theta, self.d_phi)
-            theta_list.append(theta)
-            phi_list.append(phi)
-
-        theta_bins = np.digitize(theta_list, [180 * i / 6 for i in range(1, 7)], right=True)
-        phi_bins = []
-        for i in range(len(phi_list)):
-            z = theta_bins[i]
-            if z == 0 or z == 5:
-                phi_bins.append(np.digitize(phi_list[i], [180, 360], right=True))
-            if z == 1 or z == 4:
-                phi_bins.append(np.digitize(phi_list[i], [90, 180, 270, 360], right=True))
-            if z == 2 or z == 3:
-                phi_bins.append(np.digitize(phi_list[i], [60, 120, 180, 240, 300, 360], right=True))
-
-        region_index_dict = {
-            (2, 0): 1,
-            (2, 1): 2,
-            (2, 2): 3,
-            (2, 3): 4,
-            (2, 4): 5,
-            (2, 5): 6,
-            (3, 0): 7,
-            (3, 1): 8,
-            (3, 2): 9,
-            (3, 3): 10,
-            (3, 4): 11,
-            (3, 5): 12,
-            (1, 0): 13,
-            (1, 1): 14,
-            (1, 2): 15,
-            (1, 3): 16,
-            (4, 0): 17,
-            (4, 1): 18,
-            (4, 2): 19,
-            (4, 3): 20,
-            (0, 0): 21,
-            (0, 1): 22,
-            (5, 0): 23,
-            (5, 1): 24
-        }
-
-        region_indices = []
-        for i in range(len(center_magnetization)):
-            region_indices.append(region_index_dict.get((theta_bins[i], phi_bins[i])))
-
-        return region_indices
+    def extract(self, core=False, save_csv=False):
+        super().extract(core, save_csv)
+        self.region_cache = {key: value for key, value in self.region_cache.items() if key[0] != self.step}
 
     def plot_regions(self, cmap='hsv', point_size=.9, scale=(1, 1, 1)):
         cmap = cmap
@@ -1244,10 +2471,7 @@ class MNP_Domain_Analyzer(MNP_Analyzer):
                            point_size=point_size)
 
     def plot_regions_vectors(self, cmap='hsv', head_size=2, scale=(1, 1, 1)):
-        if not os.path.isfile(os.path.join(self.mnp.filepath, 'centers_data.csv')):
-            self.extract()
-        data = np.genfromtxt(os.path.join(self.mnp.filepath, 'centers_data.csv'), delimiter=',')
-        data = data.reshape(-1, 7)
+        data = self.centers_data()
         center_magnetization = np.column_stack((data[:, 3], data[:, 4], data[:, 5]))
 
         cmap = cmap
@@ -1284,50 +2508,15 @@ class MNP_Domain_Analyzer(MNP_Analyzer):
                             line_width=.02, head_size=head_size, use_head=True)
 
     def find_regions(self):
-        region_indices = self.discretized_cmag
-        G = nx.Graph()
-        for i in range(len(self.mnp.coord_list)):
-            G.add_node(i)
-        for i in range(len(self.mnp.coord_list)):
-            for j in range(len(self.mnp.coord_list)):
-                r = self.mnp.coord_list[i] - self.mnp.coord_list[j]
-                if 0 < (r[0] ** 2 + r[1] ** 2 + r[2] ** 2) < 1.0001:
-                    G.add_edge(i, j)
-
-        def neighbor_network_checker(i, used, matches):
-            for j in G.adj[i]:
-                if region_indices[i] == region_indices[j]:
-                    if j not in matches:
-                        matches.append(j)
-            used.append(i)
-
-        def region_finder(n):
-            used = []
-            matches = [n]
-            for m in matches:
-                neighbor_network_checker(m, used, matches)
-            return len(used)
-
-        def clump_lister():
-            clumps = []
-            for i in range(len(self.mnp.coord_list)):
-                clumps.append(region_finder(i))
-            clump_list = []
-            for i in clumps:
-                num = clumps.count(i) // i
-                if i not in clump_list:
-                    for _ in range(num):
-                        clump_list.append(i)
-            return clump_list
-
-        self.region_list = clump_lister()
+        '''finds the domains of the assembly: groups of neighboring MNPs in the same discretized region. Sets
+           domain_labels, the domain of each MNP, and region_list, the size of each domain.'''
+        indptr, indices = self.mnp.neighbor_graph()
+        self.domain_labels = domain_labels(indptr, indices, self.discretized_cmag)
+        self.region_list = domain_sizes(self.domain_labels)
 
     @property
     def characteristic_size(self):
-        n = 0
-        for i in self.region_list:
-            n += i * (i)
-        return (n / len(self.mnp.coord_list))
+        return sum(i * i for i in self.region_list) / len(self.mnp.coord_list)
 
     @property
     def free_particle_fraction(self):
@@ -1370,28 +2559,73 @@ class MNP_Domain_Analyzer(MNP_Analyzer):
             f.write(self.domains_summary)
         print('MNP Summary Saved: ', os.path.join(self.mnp.filepath, 'summary_mnp_{}.md'.format(self.mnp.id)))
 
-    def save_averaged_data(self):
+    def center_magnetization(self):
+        '''returns the (n, 3) array of center magnetization vectors, extracting them first if needed'''
+        return self.centers_data()[:, 3:6]
+
+    def save_averaged_data(self, workers=1):
+        '''finds the domains for 24 orientations of the discretized regions and saves the statistics for each to
+           axes_range_data_{step}.csv. The center magnetization is loaded once and binned for every orientation at
+           the same time, and the same neighbor graph is used for each. If workers is more than 1, the domains of the
+           different orientations are found in parallel on a pool of that many processes.'''
         t0 = time.time()
+        angle_pairs = [(0, 0), (0,180),
+                      (30,0), (30, 90), (30, 180), (30, 270),
+                      (60, 0), (60, 60), (60, 120), (60, 180), (60, 240), (60, 300),
+                      (90, 0), (90, 60), (90, 120), (90, 180), (90, 240), (90, 300),
+                      (120,0), (120, 90), (120, 180), (120, 270),
+                      (150, 0), (150,180)]
+        d_theta, d_phi = np.array(angle_pairs).T
+        regions = discretize_magnetization(self.center_magnetization(), d_theta, d_phi)
+        for pair, row in zip(angle_pairs, regions):
+            self.region_cache[(self.step,) + pair] = row
+        indptr, indices = self.mnp.neighbor_graph()
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                region_lists = list(pool.map(orientation_domains, [indptr] * len(regions), [indices] * len(regions),
+                                             regions))
+        else:
+            region_lists = [orientation_domains(indptr, indices, row) for row in regions]
+
         with open(os.path.join(self.mnp.filepath, 'axes_range_data_{}.csv'.format(self.step)), 'w') as f:
             write = csv.writer(f)
             write.writerow(
                 ["d_theta", "d_phi", "Characteristic Domain Size", "Max Domain Size", "Free Particle Fraction", "2-3 Particle Fraction", "Region List"])
-            angle_pairs = [(0, 0), (0,180), 
-                          (30,0), (30, 90), (30, 180), (30, 270), 
-                          (60, 0), (60, 60), (60, 120), (60, 180), (60, 240), (60, 300),
-                          (90, 0), (90, 60), (90, 120), (90, 180), (90, 240), (90, 300),
-                          (120,0), (120, 90), (120, 180), (120, 270),
-                          (150, 0), (150,180)]
-           
-            for pair in angle_pairs:
-                    self.d_theta, self.d_phi = pair
-                    self.find_regions()
-                    data = [self.d_theta, self.d_phi, self.characteristic_size, max(self.region_list),
-                            self.free_particle_fraction, self.two_three_particle_fraction, self.region_list]
-                    write.writerow(data)
+            for pair, region_list in zip(angle_pairs, region_lists):
+                self.d_theta, self.d_phi = pair
+                self.region_list = region_list
+                data = [self.d_theta, self.d_phi, self.characteristic_size, max(self.region_list),
+                        self.free_particle_fraction, self.two_three_particle_fraction, self.region_list]
+                write.writerow(data)
+        self.domain_labels = domain_labels(indptr, indices, regions[-1])
         print("Averaged domain data saved in {} s".format(time.time()-t0))
 
 
+def domain_labels(indptr, indices, region_indices):
+    '''labels the domains of an assembly in one pass: neighbors (given by the CSR arrays from
+       Lattice.neighbor_graph()) with the same region index are joined into the same domain. Returns the domain
+       number of each MNP, numbered in order of the first MNP in each domain.'''
+    region_indices = np.asarray(region_indices)
+    n = len(indptr) - 1
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    same = region_indices[rows] == region_indices[indices]
+    graph = csr_matrix((np.ones(np.count_nonzero(same), dtype=np.int8), (rows[same], indices[same])), shape=(n, n))
+    return connected_components(graph, directed=False)[1]
+
+
+def domain_sizes(labels):
+    '''returns the list of domain sizes for the domain labels from domain_labels(). Sizes are grouped together in
+       the order they first appear going through the MNPs.'''
+    sizes = np.bincount(labels)
+    mnp_sizes = sizes[labels]
+    size_values, first = np.unique(mnp_sizes, return_index=True)
+    counts = dict(zip(*np.unique(sizes, return_counts=True)))
+    region_list = []
+    for size in size_values[np.argsort(first)].tolist():
+        region_list += [size] * int(counts[size])
+    return region_list
+
+
 def extract_domain_csv(name, number=27, filepath='./MNP_Data', filename='domain_data.csv', mode='w', B=0.001):
     with open(filename, mode) as f:
         write = csv.writer(f)
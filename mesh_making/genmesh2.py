@@ -1,5 +1,4 @@
-import csv
-import numpy as np
+import magna.utils as mu
 import sys
 import os
 
@@ -7,19 +6,8 @@ batches = int(sys.argv[1])
 
 filename = str(sys.argv[2])
 
-full_array = np.empty((1,4))
+mu.merge_mesh_labels('mesh_labels.mesh', batches)
+os.replace('mesh_labels.mesh', filename)
 
-np.savetxt(filename, full_array, delimiter=',')
-
-for i in range(batches):
-    arr = np.genfromtxt('{}.csv'.format(i), delimiter=',')
-    full_array = np.concatenate((full_array, arr))
-
-full_array = np.delete(full_array, 0, 0)
-
-np.savetxt(filename, full_array, delimiter=',')
-
-for i in range(batches):
-    os.system('rm {}.csv'.format(i))
 os.system('rm -r ./MNP_Data')
-os.system('rm *.out')
\ No newline at end of file
+os.system('rm *.out')
@@ -1,6 +1,5 @@
 import magna.utils as mu
 import sys
-import numpy as np
 
 run = int(sys.argv[1])
 
@@ -15,14 +14,4 @@ mnp = mu.MNP(run,
 ### ^^^^^^ Replace the line above MNP you want to generate a mesh for. The r_tuple, discretizations, 
 ###        form, n_layers, and layer_radius should all be specific to your MNP setup.
 
-mesh_list = list(mnp.mesh)
-
-subsize = (len(mesh_list)//batches) + 1
-
-sublist = mesh_list[subsize*run:subsize*(run+1)]
-
-arrayz=[]
-for point in sublist:
-    arrayz.append(list(point) + [mnp.if_coreshell(point)])
-
-np.savetxt('{}.csv'.format(run), np.array(arrayz), delimiter=',')
\ No newline at end of file
+mnp.pregenerate_labels('mesh_labels.mesh', shard=(run, batches))
@@ -0,0 +1,189 @@
+'''The original per-point implementations of the lattice, field, and domain code, kept so the tests can check that
+the array versions in magna.utils give exactly the same results.'''
+import math
+import numpy as np
+
+
+def num_rings(num):
+    n = 1
+    while 3 * n * (n - 1) + 1 < num:
+        n += 1
+    return n
+
+
+def num_points(rings):
+    return 3 * rings * (rings - 1) + 1
+
+
+def gen_coords(num=37, length=10):
+    n = 0
+    Nrows = num_rings(num)
+    coords = np.zeros((3 * Nrows * (Nrows - 1) + 1, 2))
+    height_factor = np.sqrt(3.0) / 2.0
+
+    for row in range(1, Nrows + 1):
+        n_in_row = 2 * Nrows - row
+        if row % 2 != 0:
+            for c in np.arange(-(n_in_row - 1) // 2, (n_in_row - 1) // 2 + 1):
+                coords[n][0] = c * length
+                coords[n][1] = (row - 1) * length * height_factor
+                n += 1
+                if row != 1:
+                    coords[n][0] = c * length
+                    coords[n][1] = -(row - 1) * length * height_factor
+                    n += 1
+        else:
+            for c in np.arange(-n_in_row / 2 + .5, n_in_row / 2):
+                coords[n][0] = c * length
+                coords[n][1] = (row - 1) * length * height_factor
+                n += 1
+                coords[n][0] = c * length
+                coords[n][1] = -(row - 1) * length * height_factor
+                n += 1
+    return coords
+
+
+def cubic_packing_coords(layer_spacing=1, layer_radius=0, shape='circle', layer_dims=(0, 0)):
+    coords = []
+    if shape == 'rectangle':
+        l, w = layer_dims
+        for x in range(-l // 2 + 1, l // 2 + 1):
+            for y in range(-w // 2 + 1, w // 2 + 1):
+                coords.append([x * layer_spacing, y * layer_spacing])
+    else:
+        for x in range(-layer_radius, layer_radius + 1):
+            for y in range(-layer_radius, layer_radius + 1):
+                if shape == 'circle':
+                    if x ** 2 + y ** 2 < layer_radius ** 2:
+                        coords.append([x * layer_spacing, y * layer_spacing])
+                if shape == 'hexagon':
+                    if abs(x) <= (2 * layer_radius - abs(y) - 1) // 2:
+                        coords.append([x * layer_spacing, y * layer_spacing])
+    return np.array(coords)
+
+
+def hexa_packing_coords(layer_spacing=1 / (3 ** .5 * 2 / 3), layer_radius=0, shape='circle', layer_dims=(0, 0)):
+    coords = []
+    if shape == 'rectangle':
+        l, w = layer_dims
+        for x in range(0, l):
+            for y in range(0, w):
+                coords.append(((2 * x + (y) % 2) * layer_spacing, (3 ** .5) * (y / 3) * layer_spacing))
+    elif shape == 'circle':
+        for x in range(-2 * layer_radius, 2 * layer_radius + 1):
+            for y in range(-2 * layer_radius, 2 * layer_radius + 1):
+                if (2 * x + y % 2) ** 2 + ((3 ** .5) * (y / 3)) ** 2 <= layer_radius ** 2:
+                    coords.append([(2 * x + (y) % 2) * layer_spacing, (3 ** .5) * (y / 3) * layer_spacing])
+    else:
+        coords = gen_coords(length=1, num=num_points(layer_radius)).reshape(-1, 2)
+        coords = coords.dot([[0, -1], [1, 0]])
+    return np.array(coords)
+
+
+def layer_coords(form, shape, layer_radius, layer_dims, layer):
+    '''the (x, y, z) coordinates of one layer of a lattice'''
+    if form in ('hcp', 'fcc'):
+        coords = hexa_packing_coords(layer_radius=layer_radius, layer_dims=layer_dims, shape=shape)
+        if (form == 'hcp' and layer % 2 == 1) or (form == 'fcc' and layer % 3 == 1):
+            coords[:, 0] = coords[:, 0] + 3 ** .5 / 3
+        elif form == 'fcc' and layer % 3 == 2:
+            coords[:, 0] = coords[:, 0] + 3 ** .5 / 6
+            coords[:, 1] = coords[:, 1] + .5
+        z = layer * 6 ** .5 / 3
+    else:
+        coords = cubic_packing_coords(layer_radius=layer_radius, layer_dims=layer_dims, shape=shape)
+        if form == 'bcc' and layer % 2 == 1:
+            coords = coords + .5
+        z = layer if form == 'scp' else layer / 2
+    z = np.linspace(z, z, len(coords[:, 0])).reshape(len(coords[:, 0]), 1)
+    return np.append(coords, z, 1)
+
+
+def list_coords(form, shape, n_layers, layer_radius=0, layer_dims=(0, 0)):
+    all_coords = np.empty((0, 0))
+    for layer in range(n_layers):
+        all_coords = np.append(all_coords, layer_coords(form, shape, layer_radius, layer_dims, layer))
+    return all_coords.reshape(-1, 3)
+
+
+def if_circle(mnp, point, r):
+    x, y, z = point
+    for n in mnp.coord_list:
+        i, j, k = n
+        if ((x - 2 * i * mnp.r_total) ** 2 + (y - 2 * j * mnp.r_total) ** 2 + (
+                z - 2 * k * mnp.r_total) ** 2) ** .5 < r:
+            return True
+    return False
+
+
+def region(mnp, point):
+    '''0 outside of the MNPs, 1 in a shell, and 2 in a core'''
+    if if_circle(mnp, point, mnp.r_shell):
+        return 2 if if_circle(mnp, point, mnp.r_core) else 1
+    return 0
+
+
+def circle_index(mnp, point):
+    x, y, z = point
+    for index, n in enumerate(mnp.coord_list.tolist()):
+        i, j, k = n
+        if ((x - 2 * i * mnp.r_total) ** 2 + (y - 2 * j * mnp.r_total) ** 2 + (
+                z - 2 * k * mnp.r_total) ** 2) ** .5 < mnp.r_total:
+            return index
+
+
+def u_func(mnp, point):
+    if not if_circle(mnp, point, mnp.r_shell):
+        return (0, 0, 1)
+    return mnp.easy_axes[circle_index(mnp, point)]
+
+
+def angle_finder(point, d_theta, d_phi):
+    x, y, z = point
+    return [((math.acos(z / math.sqrt(x ** 2 + y ** 2 + z ** 2)) * 180 / np.pi) + d_theta) % 180,
+            ((math.atan2(y, x) * 180 / np.pi) + 180 + d_phi) % 360]
+
+
+region_index_dict = {(2, 0): 1, (2, 1): 2, (2, 2): 3, (2, 3): 4, (2, 4): 5, (2, 5): 6,
+                     (3, 0): 7, (3, 1): 8, (3, 2): 9, (3, 3): 10, (3, 4): 11, (3, 5): 12,
+                     (1, 0): 13, (1, 1): 14, (1, 2): 15, (1, 3): 16,
+                     (4, 0): 17, (4, 1): 18, (4, 2): 19, (4, 3): 20,
+                     (0, 0): 21, (0, 1): 22, (5, 0): 23, (5, 1): 24}
+
+
+def discretized_cmag(center_magnetization, d_theta=0, d_phi=0):
+    region_indices = []
+    for point in center_magnetization:
+        theta, phi = angle_finder(point, d_theta, d_phi)
+        z = np.digitize(theta, [180 * i / 6 for i in range(1, 7)], right=True)
+        if z == 0 or z == 5:
+            p = np.digitize(phi, [180, 360], right=True)
+        elif z == 1 or z == 4:
+            p = np.digitize(phi, [90, 180, 270, 360], right=True)
+        else:
+            p = np.digitize(phi, [60, 120, 180, 240, 300, 360], right=True)
+        region_indices.append(region_index_dict.get((int(z), int(p))))
+    return region_indices
+
+
+def region_list(coord_list, region_indices):
+    '''the domain sizes found by MNP_Domain_Analyzer.find_regions'''
+    adj = [[j for j in range(len(coord_list)) if 0 < np.sum((coord_list[i] - coord_list[j]) ** 2) < 1.0001]
+           for i in range(len(coord_list))]
+
+    def region_finder(n):
+        used = []
+        matches = [n]
+        for m in matches:
+            for j in adj[m]:
+                if region_indices[m] == region_indices[j] and j not in matches:
+                    matches.append(j)
+            used.append(m)
+        return len(used)
+
+    clumps = [region_finder(i) for i in range(len(coord_list))]
+    clump_list = []
+    for i in clumps:
+        if i not in clump_list:
+            clump_list += [i] * (clumps.count(i) // i)
+    return clump_list
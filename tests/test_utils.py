@@ -0,0 +1,655 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+import discretisedfield as df
+import oommfc as mc
+
+import magna.utils as mu
+import reference
+
+
+@pytest.fixture(autouse=True)
+def label_cache(tmp_path_factory, monkeypatch):
+    '''keeps the mesh label cache that initialize uses out of the home directory'''
+    path = str(tmp_path_factory.mktemp('label_cache'))
+    monkeypatch.setattr(mu, 'label_cache_dir', path)
+    return path
+
+
+def make_mnp(tmp_path, **kwargs):
+    kwargs = dict(dict(form='fcc', shape='hexagon', n_layers=2, layer_radius=2, discretizations=(2, 2, 2)), **kwargs)
+    return mu.MNP(0, name='test', directory=str(tmp_path), **kwargs)
+
+
+def fake_drive(self, system, dirname='.', **kwargs):
+    '''stands in for OOMMF: sets m to the uniform field along the applied field (or z) and a one-row table'''
+    h = system.energy.zeeman.H if hasattr(system.energy, 'zeeman') else (0, 0, 1)
+    h = np.array(h, dtype=float) if np.any(h) else np.array([0., 0., 1.])
+    system.m = df.Field(system.m.mesh, dim=3, value=tuple(h / np.linalg.norm(h)), norm=system.m.norm)
+    system.table = SimpleNamespace(data=pd.DataFrame({'E': [0.0], 'mx': [h[0]], 'my': [h[1]], 'mz': [h[2]]}))
+
+
+@pytest.fixture
+def driven(tmp_path, monkeypatch):
+    monkeypatch.setattr(mc.MinDriver, 'drive', fake_drive)
+    monkeypatch.chdir(tmp_path)
+    return make_mnp(tmp_path)
+
+
+@pytest.mark.parametrize('kwargs', [dict(),
+                                    dict(form='hcp', shape='circle', layer_radius=3, discretizations=(3, 3, 3)),
+                                    dict(form='bcc', shape='rectangle', layer_dims=(3, 2), discretizations=(3, 2, 3)),
+                                    dict(form='scp', shape='hexagon', discretizations=(4, 4, 2), n_layers=1,
+                                         r_tuple=(5e-9, 3.8e-9, 3.8e-9))])
+def test_fields_match_per_point_functions(tmp_path, kwargs):
+    mnp = make_mnp(tmp_path, **kwargs)
+    mnp.make_m_field(m0=(1, 0, 0))
+    mnp.make_a_field()
+    mnp.make_k_field()
+    mnp.make_u_field()
+    regions = df.Field(mnp.mesh, dim=1, value=lambda point: reference.region(mnp, point)).array
+    for field, (shell, core) in ((mnp.a_field, (mnp.a_shell, mnp.a_core)), (mnp.k_field, (mnp.k_shell, mnp.k_core))):
+        assert np.array_equal(field.array, np.choose(regions.astype(int), [0, shell, core]))
+    u_field = df.Field(mnp.mesh, dim=3, value=lambda point: reference.u_func(mnp, point))
+    assert np.array_equal(mnp.u_field.array, u_field.array)
+    m_field = df.Field(mnp.mesh, dim=3, value=(1, 0, 0),
+                       norm=lambda point: [0, mnp.ms_shell, mnp.ms_core][reference.region(mnp, point)])
+    assert np.array_equal(mnp.m_field.array, m_field.array)
+
+
+def test_label_planes_in_chunks(tmp_path):
+    mnp = make_mnp(tmp_path, form='bcc', n_layers=3, discretizations=(3, 3, 3))
+    nz = mnp.mesh.n[2]
+    labels, spheres = mnp.label_planes(0, nz, max_memory=2e4)
+    regions = df.Field(mnp.mesh, dim=1, value=lambda point: reference.region(mnp, point)).array[..., 0]
+    index = df.Field(mnp.mesh, dim=1, value=lambda point: -1 if reference.circle_index(mnp, point) is None
+                     else reference.circle_index(mnp, point)).array[..., 0]
+    assert np.array_equal(labels, regions) and np.array_equal(spheres, index)
+    part_labels, part_spheres = mnp.label_planes(3, 7)
+    assert np.array_equal(part_labels, labels[:, :, 3:7]) and np.array_equal(part_spheres, spheres[:, :, 3:7])
+
+
+def test_find_distances_in_chunks(tmp_path):
+    mnp = make_mnp(tmp_path, form='hcp', shape='circle', layer_radius=3)
+    mnp.find_distances(max_memory=1000)
+    distance = np.linalg.norm(np.array(list(mnp.mesh))[:, np.newaxis, :] - mnp.scaled_coords, axis=2)
+    assert np.array_equal(mnp.is_in_mnp, np.any(distance < mnp.r_shell, axis=1))
+    assert np.array_equal(mnp.nearest_index, np.argmin(distance, axis=1))
+    assert np.allclose(mnp.nearest_distance, distance.min(axis=1), rtol=1e-6)
+
+
+def test_mesh_label_file(tmp_path):
+    mnp = make_mnp(tmp_path)
+    labels, spheres = mnp.label_mesh()
+    header, mapped_labels, mapped_spheres = mu.load_mesh_labels(mnp.pregenerate_labels(workers=2))
+    assert header == mnp.label_header
+    assert np.array_equal(mapped_labels, labels) and np.array_equal(mapped_spheres, spheres)
+    mesh_csv = str(tmp_path / 'mesh.csv')
+    np.savetxt(mesh_csv, np.column_stack((np.array(list(mnp.mesh)), labels.ravel(order='F'))), delimiter=',')
+    header, csv_labels, csv_spheres = mu.load_mesh_labels(mnp.convert_mesh_csv(mesh_csv))
+    assert header == mnp.label_header and np.array_equal(csv_labels, labels)
+    assert np.array_equal(csv_spheres[labels > 0], spheres[labels > 0])
+
+
+def test_alt_funcs_any_order(tmp_path):
+    mnp = make_mnp(tmp_path, form='hcp', shape='circle', layer_radius=3, discretizations=(3, 3, 3))
+    alt = make_mnp(tmp_path / 'alt', form='hcp', shape='circle', layer_radius=3, discretizations=(3, 3, 3),
+                   axes=mnp.easy_axes, mesh_labels=mnp.pregenerate_labels(workers=1))
+    points = list(mnp.mesh)
+    for i in np.random.default_rng(1).permutation(len(points))[:300]:
+        region = reference.region(mnp, points[i])
+        assert alt.alt_a_func(points[i]) == [0, mnp.a_shell, mnp.a_core][region]
+        assert alt.alt_ms_func(points[i]) == [0, mnp.ms_shell, mnp.ms_core][region]
+        assert np.array_equal(alt.alt_u_func(points[i]), reference.u_func(mnp, points[i]))
+    mnp.initialize(m0=(1, 0, 0), autosave=False, label_cache=False)
+    alt.initialize(m0=(1, 0, 0), autosave=False)
+    for field, alt_field in zip(mnp.maku(), alt.maku()):
+        assert np.array_equal(field.array, alt_field.array)
+
+
+def test_geometry_reset_on_assignment(tmp_path):
+    mnp = make_mnp(tmp_path)
+    mnp.label_mesh()
+    old_tree = mnp.sphere_tree
+    mnp.neighbor_graph()
+    mnp.r_total = 5e-9
+    assert mnp.region_labels is None and mnp.sphere_tree_cache is None and mnp.neighbor_cache is None
+    mnp.label_mesh()
+    mnp.coord_list = mnp.coord_list[:3]
+    assert mnp.region_labels is None and mnp.sphere_tree is not old_tree and mnp.sphere_tree.n == 3
+    labels, spheres = mnp.label_mesh()
+    assert set(np.unique(spheres)) <= {-1, 0, 1, 2}
+
+
+def test_label_cache(tmp_path, label_cache, monkeypatch):
+    mnp = make_mnp(tmp_path)
+    mnp.initialize(fields='a', autosave=False)
+    assert len(os.listdir(label_cache)) == 1
+    labeled = []
+    label_mesh = mu.MNP.label_mesh
+    monkeypatch.setattr(mu.MNP, 'label_mesh', lambda self, workers=1: labeled.append(self) or label_mesh(self))
+    other = make_mnp(tmp_path / 'other', axes_type='all_random', a_tuple=(1e-12, 2e-12))
+    other.initialize(fields='a', autosave=False)
+    assert not labeled and np.array_equal(other.region_labels, mnp.region_labels)
+    assert np.array_equal(other.a_field.array > 0, mnp.a_field.array > 0)
+    moved = make_mnp(tmp_path / 'moved')
+    moved.coord_list = moved.coord_list + (0, 0, 1e-3)
+    moved.initialize(fields='a', autosave=False, label_cache=False)
+    assert len(labeled) == 1 and len(os.listdir(label_cache)) == 1
+
+
+def test_mesh_labels_header_must_match(tmp_path):
+    mnp = make_mnp(tmp_path)
+    filename = mnp.pregenerate_labels(workers=1)
+    header, labels, spheres = mu.load_mesh_labels(filename, mmap=False)
+    del header['coords']
+    mu.save_mesh_labels(filename, header, labels, spheres)
+    with pytest.raises(ValueError, match='coords'):
+        make_mnp(tmp_path, mesh_labels=filename).mapped_labels()
+
+
+@pytest.mark.parametrize('form', ['hcp', 'fcc', 'scp', 'bcc'])
+@pytest.mark.parametrize('shape', ['circle', 'hexagon', 'rectangle'])
+def test_lattice_matches_reference(form, shape):
+    for radius in (1, 2, 5):
+        for n_layers in (1, 2, 4):
+            kwargs = dict(form=form, shape=shape, n_layers=n_layers, layer_radius=radius,
+                          layer_dims=(radius, radius + 2))
+            lattice = mu.Lattice(**kwargs)
+            expected = reference.list_coords(**kwargs)
+            assert lattice.list_coords().shape == expected.shape
+            assert np.array_equal(lattice.list_coords(), expected)
+            for layer in range(n_layers):
+                coords = reference.layer_coords(form, shape, radius, kwargs['layer_dims'], layer)
+                assert np.array_equal(lattice.layer_coords(layer, z=True), coords)
+                assert np.array_equal(lattice.layer_coords(layer), coords[:, :2])
+
+
+@pytest.mark.parametrize('form, shape', [('fcc', 'hexagon'), ('hcp', 'circle'), ('bcc', 'rectangle')])
+def test_neighbor_graph(tmp_path, form, shape):
+    mnp = make_mnp(tmp_path, form=form, shape=shape, n_layers=3, layer_radius=3, layer_dims=(3, 4))
+    coords = mnp.coord_list
+    indptr, indices = mnp.neighbor_graph()
+    for i in range(len(coords)):
+        expected = [j for j in range(len(coords)) if 0 < np.sum((coords[i] - coords[j]) ** 2) < 1.0001]
+        assert list(indices[indptr[i]:indptr[i + 1]]) == expected == list(mnp.neighbors(i))
+    assert mnp.neighbor_graph(networkx=True).number_of_edges() == len(indices) // 2
+    mu.save_mnp(mnp)
+    loaded = mu.load_mnp(0, name='test', filepath=str(tmp_path))
+    assert loaded.neighbor_cache is not None
+    assert np.array_equal(loaded.neighbor_cache[1], indptr) and np.array_equal(loaded.neighbor_cache[2], indices)
+    other = make_mnp(tmp_path / 'other', form=form, shape=shape, n_layers=2, layer_radius=3, layer_dims=(3, 4))
+    assert not other.load_neighbor_graph(mnp.neighbor_file)
+
+
+def test_gen_coords_matches_reference():
+    for num in (1, 5, 7, 20, 37, 100):
+        assert np.array_equal(mu.gen_coords(num, 10), reference.gen_coords(num, 10))
+
+
+@pytest.mark.parametrize('form, shape', [('fcc', 'hexagon'), ('hcp', 'circle'), ('bcc', 'rectangle')])
+def test_domains_match_reference(form, shape):
+    lattice = mu.Lattice(form=form, shape=shape, n_layers=3, layer_radius=4, layer_dims=(5, 4))
+    coords = lattice.list_coords()
+    indptr, indices = lattice.neighbor_graph()
+    for seed in range(3):
+        rng = np.random.default_rng(seed)
+        regions = np.where(rng.random(len(coords)) < .5, 7, rng.integers(1, 25, len(coords)))
+        labels = mu.domain_labels(indptr, indices, regions)
+        assert mu.domain_sizes(labels) == reference.region_list(coords, regions.tolist())
+        rows = np.repeat(np.arange(len(coords)), np.diff(indptr))
+        same = regions[rows] == regions[indices]
+        assert np.array_equal(labels[rows[same]], labels[indices[same]])
+
+
+def test_discretize_magnetization_matches_reference():
+    angles = np.radians(np.arange(0, 181, 15)), np.radians(np.arange(-180, 181, 15))
+    boundaries = [[np.cos(a) * np.sin(t), np.sin(a) * np.sin(t), np.cos(t)] for t in angles[0] for a in angles[1]]
+    m = np.vstack((np.random.default_rng(0).normal(size=(2000, 3)), boundaries,
+                   [[1, 0, 0], [0, 1, 0], [-1, 0, 0], [0, -1, 0], [0, 0, 1], [0, 0, -1], [1, 1, 0], [3 ** .5, 1, 0]]))
+    offsets = [(0, 0), (30, 90), (60, 300), (90, 60), (150, 180)]
+    for d_theta, d_phi in offsets:
+        regions = mu.discretize_magnetization(m, d_theta, d_phi)
+        assert regions.tolist() == reference.discretized_cmag(m, d_theta, d_phi)
+    d_theta, d_phi = np.array(offsets).T
+    assert np.array_equal(mu.discretize_magnetization(m, d_theta, d_phi),
+                          [mu.discretize_magnetization(m, *pair) for pair in offsets])
+
+
+def test_label_shards_merge(tmp_path):
+    mnp = make_mnp(tmp_path, form='bcc', n_layers=3, discretizations=(3, 3, 3))
+    labels, spheres = (array.copy() for array in mnp.label_mesh())
+    regions = df.Field(mnp.mesh, dim=1, value=lambda point: reference.region(mnp, point)).array[..., 0]
+    assert np.array_equal(labels, regions)
+    filename = str(tmp_path / 'labels.mesh')
+    for k in range(5):
+        mnp.pregenerate_labels(filename, shard=(k, 5))
+    mu.merge_mesh_labels(filename, 5)
+    header, merged_labels, merged_spheres = mu.load_mesh_labels(filename)
+    assert header == mnp.label_header
+    assert np.array_equal(merged_labels, labels) and np.array_equal(merged_spheres, spheres)
+    assert not any(name.startswith('labels.mesh.') for name in os.listdir(str(tmp_path)))
+    whole = mnp.pregenerate_labels(str(tmp_path / 'whole.mesh'), workers=1)
+    with open(filename, 'rb') as f, open(whole, 'rb') as g:
+        assert f.read() == g.read()
+
+
+def test_label_shards_must_cover_mesh(tmp_path):
+    mnp = make_mnp(tmp_path)
+    filename = str(tmp_path / 'labels.mesh')
+    for k in (0, 2):
+        mnp.pregenerate_labels(filename, shard=(k, 3))
+    os.rename(filename + '.2', filename + '.1')
+    with pytest.raises(ValueError):
+        mu.merge_mesh_labels(filename, 2)
+
+
+def test_manifest_from_drives_directory(tmp_path):
+    mnp = SimpleNamespace(filepath=str(tmp_path), id=3)
+    os.makedirs(str(tmp_path / 'drives'))
+    for step in (0, 1, 4):
+        (tmp_path / 'drives' / 'm_final_{}_mnp_3.ovf'.format(step)).write_text('')
+    assert mu.m_final_steps(mnp) == [0, 1, 4]
+    assert mu.how_many_m_finals(mnp) == 5
+    assert mu.allocate_steps(mnp) == 5
+    mu.record_step(mnp, 5, Bz=0.1)
+    assert mu.m_final_steps(mnp) == [0, 1, 4, 5] and mu.read_manifest(mnp)['steps']['5']['Bz'] == 0.1
+
+
+def test_hysteresis_checkpoint_resume(driven, monkeypatch):
+    mu.quick_drive(driven)
+    mu.MNP_HysteresisDriver().drive_hysteresis(driven, n=2)
+    expected = pd.read_csv(os.path.join(driven.filepath, 'hysteresis_data.csv'), index_col=0)
+    first = mu.how_many_m_finals(driven)
+
+    calls = []
+
+    def crash(self, system, dirname='.', **kwargs):
+        calls.append(None)
+        if len(calls) == 3:
+            raise KeyboardInterrupt
+        fake_drive(self, system, dirname, **kwargs)
+    monkeypatch.setattr(mc.MinDriver, 'drive', crash)
+    with pytest.raises(KeyboardInterrupt):
+        mu.MNP_HysteresisDriver().drive_hysteresis(driven, n=2, checkpoint=True)
+    assert mu.m_final_steps(driven) == list(range(first + 2))
+    monkeypatch.setattr(mc.MinDriver, 'drive', fake_drive)
+    mu.MNP_HysteresisDriver().drive_hysteresis(driven, n=2, checkpoint=True)
+
+    table = pd.read_csv(os.path.join(driven.filepath, 'hysteresis_data.csv'), index_col=0)
+    pd.testing.assert_frame_equal(table, expected)
+    assert mu.m_final_steps(driven) == list(range(first + len(expected)))
+    assert mu.how_many_m_finals(driven) == first + len(expected)
+    assert not os.path.isfile(os.path.join(driven.filepath, 'hysteresis_checkpoint.csv'))
+
+
+def unit_drive(self, system, dirname='.', **kwargs):
+    '''like fake_drive, with the average magnetization in the table normalized'''
+    fake_drive(self, system, dirname, **kwargs)
+    m = system.table.data[['mx', 'my', 'mz']].to_numpy()
+    system.table.data[['mx', 'my', 'mz']] = m / np.linalg.norm(m, axis=1)[:, np.newaxis]
+
+
+def test_adaptive_hysteresis(driven, monkeypatch):
+    monkeypatch.setattr(mc.MinDriver, 'drive', unit_drive)
+    hmin, hmax = np.array((2e4, 0, -1e6)), np.array((2e4, 0, 1e6))
+    driven.initialize(autosave=False)
+    driver = mu.MNP_HysteresisDriver()
+    driver.drive_adaptive_hysteresis(driven, Hmin=hmin, Hmax=hmax, threshold=0.3, min_step=0.005, max_step=0.25,
+                                     max_stages=1000)
+    table = pd.read_csv(os.path.join(driven.filepath, 'hysteresis_data.csv'), index_col=0)
+    assert mu.m_final_steps(driven) == list(range(len(table)))
+    h = table[['Bx', 'By', 'Bz']].to_numpy() / mu.mm.consts.mu0
+    assert np.allclose(h[0], hmin) and np.allclose(h[-1], hmin) and np.allclose(h[np.argmax(h[:, 2])], hmax)
+    top = np.argmax(h[:, 2])
+    assert np.all(np.diff(h[:top + 1, 2]) > 0) and np.all(np.diff(h[top:, 2]) < 0)
+    steps = np.abs(np.diff(h[:, 2])) / (hmax[2] - hmin[2])
+    change = np.linalg.norm(np.diff(table[['mx', 'my', 'mz']].to_numpy(), axis=0), axis=1)
+    assert np.all((change <= 0.3) | (steps <= 0.005 + 1e-9))
+    assert steps.max() == pytest.approx(0.25) and steps.min() < 0.05
+    assert len(driver.stage_times) > len(table)  # some stages were redone with a smaller step
+    driver.drive_adaptive_hysteresis(driven, Hmin=hmin, Hmax=hmax, threshold=0.3, max_stages=5)
+    table = pd.read_csv(os.path.join(driven.filepath, 'hysteresis_data.csv'), index_col=0)
+    assert len(table) <= 5 and np.allclose(table['Bz'].max() / mu.mm.consts.mu0, hmax[2])
+    with pytest.raises(ValueError, match='max_stages'):
+        driver.drive_adaptive_hysteresis(driven, Hmin=hmin, Hmax=hmax, max_stages=2)
+
+
+def scratch_drive(self, system, dirname='.', **kwargs):
+    '''like fake_drive, but leaves a file in the OOMMF directory and fails for MNP 1'''
+    open(os.path.join(dirname, 'drive.mif'), 'w').close()
+    if system.name == 'mnp_1':
+        raise RuntimeError('OOMMF failed')
+    fake_drive(self, system, dirname, **kwargs)
+
+
+def test_hysteresis_pool_scratch_dirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(mc.MinDriver, 'drive', scratch_drive)
+    monkeypatch.chdir(tmp_path)
+    mnps = [mu.MNP(i, name='pool', directory=str(tmp_path), form='fcc', shape='hexagon', n_layers=2, layer_radius=2,
+                   discretizations=(2, 2, 2)) for i in range(3)]
+    for mnp in mnps:
+        mnp.initialize(autosave=False)
+    with mu.scratch_dir(mnps[0]) as first, mu.scratch_dir(mnps[0]) as second:
+        assert first != second and os.path.dirname(first) == mnps[0].filepath
+    assert not os.path.exists(first) and not os.path.exists(second)
+    results = mu.hysteresis_pool(mnps, workers=3, n=2)
+    assert isinstance(results[1], RuntimeError) and all(isinstance(results[i], float) for i in (0, 2))
+    for mnp in mnps:
+        scratch = [name for name in os.listdir(mnp.filepath) if name.startswith('oommf_')]
+        if mnp.id == 1:
+            assert len(scratch) == 1
+            assert os.listdir(os.path.join(mnp.filepath, scratch[0])) == ['drive.mif']
+        else:
+            assert scratch == [] and len(mu.m_final_steps(mnp)) == 5
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.mif') or name.startswith('mnp_')]
+
+
+def test_hysteresis_checkpoint_other_fields(tmp_path):
+    filename = str(tmp_path / 'checkpoint.csv')
+    h_list = mu.make_h_list((0, 0, -1e6), (0, 0, 1e6), 2)
+    row = mu.hysteresis_row(pd.DataFrame({'E': [0.0], 'mx': [0.0], 'my': [0.0], 'mz': [1.0]}), 0, h_list[0])
+    mu.save_hysteresis_checkpoint(filename, [row], 7, h_list)
+    rows, first_step = mu.load_hysteresis_checkpoint(filename, h_list)
+    assert first_step == 7 and len(rows) == 1
+    pd.testing.assert_frame_equal(rows[0][row.columns], row, check_dtype=False)
+    assert mu.load_hysteresis_checkpoint(filename, mu.make_h_list((0, 0, -1e6), (0, 0, 1e6), 3)) == ([], None)
+
+
+def test_run_batch(driven, tmp_path):
+    base = dict(name='batch', directory=str(tmp_path), form='fcc', shape='hexagon', n_layers=2, layer_radius=2,
+                discretizations=(2, 2, 2))
+    specs = [dict(base), dict(base, drive='bogus'), dict(base, form='xyz'), dict(base, id=0, analyze=False)]
+    summary = mu.run_batch(specs, workers=2, retries=2, summary_file=str(tmp_path / 'summary.csv'))
+    assert list(summary['Status']) == ['done', 'failed', 'failed', 'done']
+    assert list(summary['Id']) == [1, 2, 3, 0] and list(summary['Attempts']) == [1, 0, 1, 1]
+    assert 'drive must be one of' in summary['Error'][1] and 'NameError' in summary['Error'][2]
+    assert pd.read_csv(tmp_path / 'summary.csv')['Status'].tolist() == list(summary['Status'])
+    assert os.path.isfile(tmp_path / 'batch' / 'mnp_1' / 'domain_data_mnp_1.csv')
+
+
+def step_mnp(tmp_path):
+    mnp = make_mnp(tmp_path)
+    os.makedirs(os.path.join(mnp.filepath, 'drives'))
+    mesh = df.Mesh(p1=(0, 0, 0), p2=(8e-9, 6e-9, 5e-9), n=(8, 6, 5))
+    field = df.Field(mesh, dim=3, value=np.random.default_rng(0).normal(size=(8, 6, 5, 3)))
+    return mnp, field
+
+
+def test_h5_step_roundtrip(tmp_path, monkeypatch):
+    pytest.importorskip('h5py')
+    mnp, field = step_mnp(tmp_path)
+    for step in (0, 1):
+        mu.record_step(mnp, step, **mu.save_step_field(mnp, field * (step + 1), step, store='h5'))
+    assert not any(name.endswith('.ovf') for name in os.listdir(os.path.join(mnp.filepath, 'drives')))
+    assert mu.m_final_steps(mnp) == [0, 1]
+    for step in (0, 1):
+        assert np.array_equal(mu.load_step_field(mnp, step).array, (field * (step + 1)).array)
+        for z in (0.5e-9, 2.7e-9, 4.5e-9):
+            plane = mu.load_step_plane(mnp, step, z)
+            expected = (field * (step + 1)).plane(z=z)
+            assert np.array_equal(plane.array, expected.array)
+            assert np.allclose(plane.mesh.region.pmin, expected.mesh.region.pmin, rtol=1e-12, atol=0)
+    filename = mu.export_step_ovf(mnp, 1, str(tmp_path / 'step_1.ovf'))
+    assert np.allclose(df.Field.fromfile(filename).array, (field * 2).array)
+    drives = os.listdir(os.path.join(mnp.filepath, 'drives'))
+    assert '.steps_mnp_0.h5.lock' in drives and 'steps_mnp_0.h5.lock' not in drives
+    monkeypatch.setattr(mu, 'h5py', None)
+    with pytest.raises(ImportError, match='h5py'):
+        mu.load_step_plane(mnp, 0, 0.5e-9)
+
+
+def test_ovf_plane(tmp_path):
+    mnp, field = step_mnp(tmp_path)
+    mu.record_step(mnp, 0, **mu.save_step_field(mnp, field, 0, store='ovf'))
+    filename = os.path.join(mnp.filepath, 'drives', 'm_final_0_mnp_0.ovf')
+    for z in (0.5e-9, 1e-9, 2.7e-9, 4.5e-9, 5e-9):
+        assert mu.ovf_plane(filename, z) == field.plane(z=z)
+        assert np.array_equal(mu.load_step_plane(mnp, 0, z).array, field.plane(z=z).array)
+    field.write(filename, representation='txt')
+    assert mu.ovf_plane(filename, 0.5e-9) is None
+    assert np.allclose(mu.load_step_plane(mnp, 0, 0.5e-9).array, field.plane(z=0.5e-9).array)
+
+
+def test_step_file_shared_by_readers(tmp_path):
+    mnp, field = step_mnp(tmp_path)
+    mu.record_step(mnp, 0, **mu.save_step_field(mnp, field, 0, store='ovf'))
+    analyzer = mu.MNP_Analyzer(mnp, step=0, preload_field=False)
+    source = mu.step_source(mnp, 0)
+    assert np.array_equal(analyzer.load_plane(1e-9).array, field.plane(z=1e-9).array)
+    (field * 2).write(os.path.join(mnp.filepath, 'm_final_mnp_0.ovf'))
+    assert mu.step_file(mnp, 0)[1] == os.path.join(mnp.filepath, 'm_final_mnp_0.ovf')
+    assert mu.step_source(mnp, 0) != source
+    assert np.array_equal(analyzer.load_plane(1e-9).array, (field * 2).plane(z=1e-9).array)
+    analyzer.load_field()
+    assert np.array_equal(analyzer.field.array, (field * 2).array)
+    assert np.array_equal(mu.load_step_field(mnp, 0).array, (field * 2).array)
+
+
+def test_artifact_cache(tmp_path):
+    filename = str(tmp_path / 'plot.png')
+    assert not mu.artifact_current(filename, 'a')
+    (tmp_path / 'plot.png').write_text('')
+    mu.record_artifact(filename, 'a')
+    assert mu.artifact_current(filename, 'a')
+    assert not mu.artifact_current(filename, 'b')
+    assert not os.path.isfile(filename)
+    (tmp_path / 'other.png').write_text('')
+    mu.record_artifact(str(tmp_path / 'other.png'), 'c')
+    mu.prune_artifacts(str(tmp_path), [])
+    assert not os.path.isfile(str(tmp_path / 'other.png')) and mu.read_artifacts(str(tmp_path)) == {}
+
+
+def test_plots_are_cached(tmp_path, monkeypatch):
+    mnp, field = step_mnp(tmp_path)
+    mu.record_step(mnp, 0, **mu.save_step_field(mnp, field, 0, store='ovf'))
+    renders = []
+
+    def fake_mpl(self, filename=None, **kwargs):
+        renders.append(filename)
+        open(filename, 'w').close()
+    monkeypatch.setattr(df.Field, 'mpl', fake_mpl)
+    analyzer = mu.MNP_Analyzer(mnp, step=0, preload_field=False)
+    assert analyzer.z_plot(figsize=(2, 2)) is not None and len(renders) == 1
+    assert analyzer.z_plot(figsize=(2, 2)) is None and len(renders) == 1
+    analyzer.z_plot(figsize=(2, 2), z_plane=3e-9)
+    assert len(renders) == 2
+    analyzer.z_plot(figsize=(2, 2), cache=False)
+    assert len(renders) == 3
+    time.sleep(0.01)
+    mu.record_step(mnp, 0, **mu.save_step_field(mnp, field * 2, 0, store='ovf'))
+    analyzer.z_plot(figsize=(2, 2), z_plane=3e-9)
+    assert len(renders) == 4
+    analyzer.field = field
+    analyzer.z_plot(figsize=(2, 2), z_plane=3e-9)
+    assert len(renders) == 5
+    mu.plt.close('all')
+
+
+def test_extract_matches_field_probes(tmp_path):
+    mnp, _ = step_mnp(tmp_path)
+    field = df.Field(mnp.mesh, dim=3, value=np.random.default_rng(0).normal(size=tuple(mnp.mesh.n) + (3,)))
+    mu.record_step(mnp, 0, **mu.save_step_field(mnp, field, 0, store='ovf'))
+    analyzer = mu.MNP_Analyzer(mnp, step=0)
+    analyzer.extract(save_csv=True)
+    centers = analyzer.centers_data()
+    orientation = analyzer.field.orientation
+    probes = np.array([orientation(point) for point in mnp.scaled_coords])
+    assert np.allclose(centers[:, :3], mnp.scaled_coords) and np.allclose(centers[:, 3:6], probes)
+    values = np.array([analyzer.field(point) for point in mnp.scaled_coords])
+    assert np.allclose(centers[:, 6] % (2 * np.pi), np.arctan2(values[:, 1], values[:, 0]) % (2 * np.pi))
+    assert np.allclose(np.loadtxt(os.path.join(mnp.filepath, 'centers_data_0.csv'), delimiter=',', skiprows=1),
+                       centers)
+    analyzer.extract(core=True)
+    labels, spheres = mnp.label_mesh()
+    for i in range(len(mnp.coord_list)):
+        in_core = (labels == 2) & (spheres == i)
+        if in_core.any():
+            assert np.allclose(analyzer.centers_data()[i, 3:6], orientation.array[in_core].mean(axis=0))
+
+
+def test_centers_data_store(tmp_path, monkeypatch):
+    mnp, field = step_mnp(tmp_path)
+    mu.record_step(mnp, 0, **mu.save_step_field(mnp, field, 0, store='ovf'))
+    centers = mu.MNP_Analyzer(mnp, step=0).centers_data()
+    with np.load(os.path.join(mnp.filepath, 'centers_data_0.npz')) as data:
+        assert sorted(data.files) == sorted(mu.centers_columns)
+        assert all(data[c].shape == (len(mnp.coord_list),) for c in mu.centers_columns)
+    monkeypatch.setattr(mu.MNP_Analyzer, 'extract', lambda self, **kwargs: pytest.fail('extracted again'))
+    analyzer = mu.MNP_Analyzer(mnp, step=0, preload_field=False)
+    assert np.array_equal(analyzer.centers_data(), centers) and analyzer.centers_data() is analyzer.centers_data()
+    os.remove(os.path.join(mnp.filepath, 'centers_data_0.npz'))
+    for header in (False, True):
+        np.savetxt(os.path.join(mnp.filepath, 'centers_data.csv'), centers, delimiter=',',
+                   header=','.join(mu.centers_columns) if header else '', comments='')
+        analyzer = mu.MNP_Analyzer(mnp, step=0, preload_field=False)
+        assert np.allclose(analyzer.centers_data(), centers)
+
+
+def test_extract_all_steps(tmp_path, monkeypatch):
+    mnp, field = step_mnp(tmp_path)
+    for step in range(3):
+        mu.record_step(mnp, step, **mu.save_step_field(mnp, field * (step + 1), step, store='ovf'))
+    monkeypatch.setattr(df.Field, 'mpl', lambda self, filename=None, **kwargs: open(filename, 'w').close())
+    analyzer = mu.MNP_Domain_Analyzer(mnp, step=1)
+    assert analyzer.z_plot(figsize=(2, 2)) is not None
+    assert analyzer.extract_all_steps() == [0, 1, 2]
+    assert analyzer.step == 1 and analyzer.field is analyzer.loaded_field
+    assert analyzer.z_plot(figsize=(2, 2)) is None
+    centers = analyzer.centers_data()
+    assert centers.shape == (len(mnp.coord_list), 7)
+    assert np.allclose(np.linalg.norm(centers[:, 3:6], axis=1), 1)
+    index = tuple(np.clip(np.round(np.divide(mnp.scaled_coords - field.mesh.region.pmin, field.mesh.cell) - 0.5),
+                          0, np.subtract(field.mesh.n, 1)).astype(int).T)
+    assert np.allclose(centers[:, 3:6], field.orientation.array[index])
+    for step in range(3):
+        assert os.path.isfile(os.path.join(mnp.filepath, 'centers_data_{}.npz'.format(step)))
+    mu.plt.close('all')
+
+
+def drawn_mpl(self, ax=None, filename=None, **kwargs):
+    '''stands in for Field.mpl: draws the z component of a plane and saves the figure to filename'''
+    ax.imshow(self.array[:, :, 0, -1])
+    if filename is not None:
+        ax.figure.savefig(filename)
+
+
+def test_render_steps(tmp_path, monkeypatch):
+    mnp, field = step_mnp(tmp_path)
+    for step in range(3):
+        mu.record_step(mnp, step, **mu.save_step_field(mnp, field * (step + 1), step, store='ovf'))
+    monkeypatch.setattr(df.Field, 'mpl', drawn_mpl)
+    analyzer = mu.MNP_Hysteresis_Analyzer(mnp)
+    frames = list(analyzer.render_steps('z', workers=2, frame_size=(64, 48), figsize=(4, 3)))
+    assert [step for step, frame in frames] == [0, 1, 2]
+    assert all(frame.shape == (48, 64, 3) and frame.dtype == np.uint8 for step, frame in frames)
+    with pytest.raises(AttributeError):
+        analyzer.hyst_steps_plot('z', title='Z')
+    analyzer.hyst_steps_plot('z', workers=2, figsize=(2, 2))
+    savepath = os.path.join(analyzer.path, 'z_hysteresis_plot')
+    pngs = [os.path.join(savepath, 'z_plot_{}.png'.format(step)) for step in range(3)]
+    assert sorted(name for name in os.listdir(savepath) if name.endswith('.png')) == [os.path.basename(f) for f in pngs]
+    mtimes = [os.stat(f).st_mtime_ns for f in pngs]
+    cached = list(analyzer.render_steps('z', workers=1, savepath=savepath, frame_size=(64, 48), figsize=(2, 2)))
+    assert [os.stat(f).st_mtime_ns for f in pngs] == mtimes
+    assert all(frame.shape == (48, 64, 3) for step, frame in cached)
+    analyzer.hyst_movie('z', workers=2, frame_size=(64, 48), figsize=(2, 2))
+    movie = cv2.VideoCapture(os.path.join(analyzer.path, 'z_hysteresis.mp4'))
+    assert movie.get(cv2.CAP_PROP_FRAME_COUNT) == 3 and movie.get(cv2.CAP_PROP_FRAME_WIDTH) == 64
+    movie.release()
+    mu.plt.close('all')
+
+
+def test_save_averaged_data(tmp_path):
+    mnp, _ = step_mnp(tmp_path)
+    field = df.Field(mnp.mesh, dim=3, value=np.random.default_rng(0).normal(size=tuple(mnp.mesh.n) + (3,)))
+    mu.record_step(mnp, 0, **mu.save_step_field(mnp, field, 0, store='ovf'))
+    analyzer = mu.MNP_Domain_Analyzer(mnp, step=0)
+    coords, m = mnp.coord_list, analyzer.center_magnetization()
+    tables = []
+    for workers in (1, 2):
+        analyzer.save_averaged_data(workers=workers)
+        tables.append(pd.read_csv(os.path.join(mnp.filepath, 'axes_range_data_0.csv')))
+    assert tables[0].equals(tables[1]) and len(tables[0]) == 24
+    for row in tables[0].itertuples(index=False):
+        regions = reference.discretized_cmag(m.tolist(), row.d_theta, row.d_phi)
+        assert analyzer.region_cache[(0, row.d_theta, row.d_phi)].tolist() == regions
+        region_list = reference.region_list(coords, regions)
+        assert json.loads(row[-1]) == region_list and row[3] == max(region_list)
+
+
+def test_stage_magnetization_files(tmp_path):
+    names = ['m0.omf', 'mnp-Oxs_MinDriver-Magnetization-10-0000123.omf',
+             'mnp-Oxs_MinDriver-Magnetization-02-0000045.omf', 'mnp-Oxs_MinDriver-Magnetization-02-0000012.omf',
+             'mnp-Oxs_MinDriver-Magnetization-00-0000007.omf', 'other-Oxs_MinDriver-Magnetization-01-0000003.omf',
+             'mnp.mif', 'mnp.odt']
+    for name in names:
+        (tmp_path / name).write_text('')
+    assert mu.stage_magnetization_files(str(tmp_path), 'mnp') == [
+        'mnp-Oxs_MinDriver-Magnetization-00-0000007.omf', 'mnp-Oxs_MinDriver-Magnetization-02-0000045.omf',
+        'mnp-Oxs_MinDriver-Magnetization-10-0000123.omf']
+
+
+class StopDrive(Exception):
+    pass
+
+
+class MifRunner:
+    '''stands in for the OOMMF runner: keeps the MIF file of each drive and stops before OOMMF would run'''
+    def __init__(self):
+        self.mifs = []
+
+    def call(self, argstr, **kwargs):
+        with open(argstr) as f:
+            self.mifs.append(f.read())
+        raise StopDrive
+
+
+@pytest.mark.parametrize('native, zeeman', [(True, ['Oxs_UZeeman']), (False, ['Oxs_FixedZeeman'])])
+def test_hysteresis_mif_zeeman_terms(tmp_path, monkeypatch, native, zeeman):
+    monkeypatch.chdir(tmp_path)
+    mnp = make_mnp(tmp_path, n_layers=1)
+    runner = MifRunner()
+    with pytest.raises(StopDrive):
+        mu.MNP_HysteresisDriver().drive_hysteresis(mnp, n=2, native=native, runner=runner)
+    terms = [line.split()[1].split(':')[0] for line in runner.mifs[0].splitlines()
+             if line.startswith('Specify') and 'Zeeman' in line]
+    assert terms == zeeman
+
+
+def locked_increments(filename, n):
+    for _ in range(n):
+        with mu.file_lock(filename):
+            with open(filename) as f:
+                count = int(f.read())
+            with open(filename, 'w') as f:
+                f.write(str(count + 1))
+
+
+def test_file_lock(tmp_path):
+    filename = str(tmp_path / 'counter')
+    with open(filename, 'w') as f:
+        f.write('0')
+    with ProcessPoolExecutor(4) as pool:
+        list(pool.map(locked_increments, [filename] * 4, [50] * 4))
+    with open(filename) as f:
+        assert int(f.read()) == 200
+
+
+def allocate_many(filepath, n):
+    mnp = SimpleNamespace(filepath=filepath, id=0)
+    return [mu.allocate_steps(mnp, 2) for _ in range(n)]
+
+
+def test_allocate_steps_concurrent(tmp_path):
+    with ProcessPoolExecutor(4) as pool:
+        steps = sum(pool.map(allocate_many, [str(tmp_path)] * 4, [25] * 4), [])
+    assert sorted(steps) == list(range(0, 200, 2))
+    assert mu.how_many_m_finals(SimpleNamespace(filepath=str(tmp_path), id=0)) == 200
@@ -91,6 +91,5 @@ print('\033[0;31mFAILED: {}\033[0;0m'.format(failed))
 if failed==0:
     print('Test Complete... SUCCESS!')
     os.system('rm -r MAGNA-U_TEST')
-    os.system('rm -r DELETE')
 else:
     print('Failures: ',fail_list)
\ No newline at end of file